@@ -9,6 +9,7 @@ from .flashdecoding import flash_decoding
 from .skip_rmsnorm import skip_rmsnorm
 from .swiglu import swiglu_forward
 from .rope_emb import (rope_forward, rope_emb_forward)
+from .fused_qkv_rope import fused_qkv_rope
 from .softmax_split import softmax_split
 from .update_kv_buffer import update_kv_buffer
 from .update_kv_index import update_kv_index
@@ -0,0 +1,366 @@
+# https://github.com/ModelTC/lightllm/blob/main/lightllm/models/llama/triton_kernel/context_flashattention_nopad.py
+# https://triton-lang.org/main/getting-started/tutorials/06-fused-attention.html
+
+import torch, math
+import triton
+import triton.language as tl
+from torch.amp import custom_fwd
+
+@triton.jit
+def _attn_fwd_inner(
+    acc, m_i, l_i, q,
+    k_ptrs, v_ptrs,
+    k_seq_stride, v_seq_stride,
+    m_pos, n_range_offs,
+    n_size,
+    start_n, end_n, # 本段循环处理的 K/V 序列范围 [start_n, end_n)
+    BLOCK_N_SIZE: tl.constexpr,
+    APPLY_MASK: tl.constexpr, # 对角线块和尾块需要 mask, 其余块 mask 全为 True, 无需计算
+    causal_mask: tl.constexpr,
+):
+    for block_n_start_idx in range(start_n, end_n, BLOCK_N_SIZE):
+        block_n_start_idx = tl.multiple_of(block_n_start_idx, BLOCK_N_SIZE)
+        block_n_offs = block_n_start_idx + n_range_offs
+
+        if APPLY_MASK:
+            k_mask = block_n_offs[None, :] < n_size
+            k = tl.load(k_ptrs + block_n_start_idx * k_seq_stride, mask=k_mask, other=0.0)
+        else:
+            k = tl.load(k_ptrs + block_n_start_idx * k_seq_stride)
+
+        qk = tl.dot(q, k) # (BLOCK_M_SIZE, Hd)@(Hd, BLOCK_N_SIZE)->(BLOCK_M_SIZE, BLOCK_N_SIZE)
+
+        if APPLY_MASK:
+            if causal_mask: # casual 模型的 causal mask 下三角矩阵
+                k_mask = k_mask & (m_pos[:, None] >= block_n_offs[None, :])
+            qk = tl.where(k_mask, qk, float("-inf"))
+
+        m_ij = tl.maximum(m_i, tl.max(qk, 1)) # 更新行最大值
+        p = tl.exp2(qk - m_ij[:, None]) # sm_scale 已乘 log2(e), exp2 直接对应硬件指令
+        alpha = tl.exp2(m_i - m_ij) # 旧累加项的缩放系数
+
+        if APPLY_MASK:
+            v = tl.load(v_ptrs + block_n_start_idx * v_seq_stride, mask=block_n_offs[:, None] < n_size, other=0.0)
+        else:
+            v = tl.load(v_ptrs + block_n_start_idx * v_seq_stride)
+        acc = acc * alpha[:, None] + tl.dot(p.to(v.dtype), v)
+        l_i = l_i * alpha + tl.sum(p, 1)
+        m_i = m_ij
+
+    return acc, m_i, l_i
+
+@triton.jit
+def _attn_fwd_inner_block_ptr(
+    acc, m_i, l_i, q,
+    k_block_ptr, v_block_ptr, # 已定位到 start_n 的 block pointer, K 为转置后的 [Hd, BLOCK_N_SIZE] 视图
+    m_pos, n_range_offs,
+    n_size,
+    start_n, end_n, # 本段循环处理的 K/V 序列范围 [start_n, end_n)
+    BLOCK_N_SIZE: tl.constexpr,
+    APPLY_MASK: tl.constexpr,
+    causal_mask: tl.constexpr,
+):
+    """与 _attn_fwd_inner 相同的 FA2 递推, K/V 通过 tl.make_block_ptr 加载, 越界由 boundary_check 补零"""
+    for block_n_start_idx in range(start_n, end_n, BLOCK_N_SIZE):
+        block_n_start_idx = tl.multiple_of(block_n_start_idx, BLOCK_N_SIZE)
+        block_n_offs = block_n_start_idx + n_range_offs
+
+        if APPLY_MASK:
+            k = tl.load(k_block_ptr, boundary_check=(1,), padding_option="zero")
+        else:
+            k = tl.load(k_block_ptr)
+
+        qk = tl.dot(q, k) # (BLOCK_M_SIZE, Hd)@(Hd, BLOCK_N_SIZE)->(BLOCK_M_SIZE, BLOCK_N_SIZE)
+
+        if APPLY_MASK:
+            k_mask = block_n_offs[None, :] < n_size
+            if causal_mask: # casual 模型的 causal mask 下三角矩阵
+                k_mask = k_mask & (m_pos[:, None] >= block_n_offs[None, :])
+            qk = tl.where(k_mask, qk, float("-inf"))
+
+        m_ij = tl.maximum(m_i, tl.max(qk, 1)) # 更新行最大值
+        p = tl.exp2(qk - m_ij[:, None])
+        alpha = tl.exp2(m_i - m_ij) # 旧累加项的缩放系数
+
+        if APPLY_MASK:
+            v = tl.load(v_block_ptr, boundary_check=(0,), padding_option="zero")
+        else:
+            v = tl.load(v_block_ptr)
+        acc = acc * alpha[:, None] + tl.dot(p.to(v.dtype), v)
+        l_i = l_i * alpha + tl.sum(p, 1)
+        m_i = m_ij
+
+        k_block_ptr = tl.advance(k_block_ptr, (0, BLOCK_N_SIZE))
+        v_block_ptr = tl.advance(v_block_ptr, (BLOCK_N_SIZE, 0))
+
+    return acc, m_i, l_i
+
+# grid(cdiv(G*M, BLOCK_M_SIZE), B*KVH, 1), 同一 kv head 下的 G 个 q head 被折叠进 M 维,
+# 每个线程 block 处理一个 kv head 对应的 BLOCK_M_SIZE 行 q, K/V tile 只从 HBM 读取一次
+@triton.jit
+def flash_attention_v1_kernel(
+    q_ptr,
+    k_ptr,
+    v_ptr,
+    o_ptr,
+
+    q_batch_stride,
+    q_heads_stride,
+    q_seq_stride,
+    q_dim_stride,
+
+    k_batch_stride,
+    k_heads_stride,
+    k_seq_stride,
+    k_dim_stride,
+
+    v_batch_stride,
+    v_heads_stride,
+    v_seq_stride,
+    v_dim_stride,
+
+    out_batch_stride,
+    out_heads_stride,
+    out_seq_stride,
+    out_dim_stride,
+
+    n_kv_heads,   # number of kv heads
+    m_size,       # sequence length of q
+    q_rows,       # rows of folded Q matrix, num_kv_groups * m_size
+    n_size,       # sequence length of k, also be rows of K matrix
+    BLOCK_DHEAD_SIZE: tl.constexpr, # head_dim dimension
+    BLOCK_M_SIZE: tl.constexpr, # BLOCK size of m_size dimension
+    BLOCK_N_SIZE: tl.constexpr, # BLOCK size of n_size dimension
+    sm_scale,
+    causal_mask: tl.constexpr,
+    USE_BLOCK_PTR: tl.constexpr, # 使用 tl.make_block_ptr/tl.advance 寻址 Q K V O, 否则使用指针运算
+):
+    """
+    flashattention 内核实现, online-softmax 采用 FA2 递推:
+    只维护行最大值 m_i 和未归一化的指数和 l_i, 循环结束后统一做一次 1/l_i 归一化
+    """
+    block_m_idx = tl.program_id(0)
+    head_idx = tl.program_id(1)
+
+    cur_batch_idx = head_idx // n_kv_heads
+    cur_head_idx = head_idx % n_kv_heads # Q 已按 kv head 折叠, Q 与 K/V 使用同一个 head 索引
+
+    m_range_offs = tl.arange(0, BLOCK_M_SIZE) # seq_dim 维度偏移
+    n_range_offs = tl.arange(0, BLOCK_N_SIZE) # kv seq_dim 维度偏移
+    dhead_range_offs = tl.arange(0, BLOCK_DHEAD_SIZE) # head_dim 维度偏移
+
+    m_offs = block_m_idx * BLOCK_M_SIZE + m_range_offs
+    m_pos = m_offs % m_size # 折叠行映射回原始序列位置, 用于 causal mask
+
+    # m_i 是行最大值, l_i 是未归一化的 softmax 分母, acc 是未归一化的 attention 输出累加器
+    m_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32) - float("inf")
+    l_i = tl.zeros([BLOCK_M_SIZE,], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_M_SIZE, BLOCK_DHEAD_SIZE], dtype=tl.float32)
+
+    # causal 时只有对角线附近的 K 块需要 mask, 对角线以上的 K 块全被遮住, 无需迭代;
+    # 折叠后一个 tile 可能跨越两个 q head, 此时按整段序列保守处理
+    if causal_mask:
+        pos_start = (block_m_idx * BLOCK_M_SIZE) % m_size
+        wraps = pos_start + BLOCK_M_SIZE > m_size
+        mask_start = tl.minimum(tl.where(wraps, 0, pos_start), n_size)
+        end_n = tl.minimum(tl.where(wraps, m_size, pos_start + BLOCK_M_SIZE), n_size)
+    else:
+        mask_start = n_size
+        end_n = n_size
+    mask_start = (mask_start // BLOCK_N_SIZE) * BLOCK_N_SIZE
+
+    if USE_BLOCK_PTR:
+        q_base = q_ptr + cur_batch_idx * q_batch_stride + cur_head_idx * q_heads_stride
+        k_base = k_ptr + cur_batch_idx * k_batch_stride + cur_head_idx * k_heads_stride
+        v_base = v_ptr + cur_batch_idx * v_batch_stride + cur_head_idx * v_heads_stride
+        q_block_ptr = tl.make_block_ptr(
+            base=q_base, shape=(q_rows, BLOCK_DHEAD_SIZE), strides=(q_seq_stride, q_dim_stride),
+            offsets=(block_m_idx * BLOCK_M_SIZE, 0), block_shape=(BLOCK_M_SIZE, BLOCK_DHEAD_SIZE), order=(1, 0),
+        )
+        # K 按转置后的 [BLOCK_DHEAD_SIZE, BLOCK_N_SIZE] 视图加载
+        k_block_ptr = tl.make_block_ptr(
+            base=k_base, shape=(BLOCK_DHEAD_SIZE, n_size), strides=(k_dim_stride, k_seq_stride),
+            offsets=(0, 0), block_shape=(BLOCK_DHEAD_SIZE, BLOCK_N_SIZE), order=(0, 1),
+        )
+        v_block_ptr = tl.make_block_ptr(
+            base=v_base, shape=(n_size, BLOCK_DHEAD_SIZE), strides=(v_seq_stride, v_dim_stride),
+            offsets=(0, 0), block_shape=(BLOCK_N_SIZE, BLOCK_DHEAD_SIZE), order=(1, 0),
+        )
+
+        q = tl.load(q_block_ptr, boundary_check=(0,), padding_option="zero")
+        q = (q * sm_scale).to(q_ptr.dtype.element_ty)
+
+        acc, m_i, l_i = _attn_fwd_inner_block_ptr(
+            acc, m_i, l_i, q,
+            k_block_ptr, v_block_ptr,
+            m_pos, n_range_offs,
+            n_size,
+            0, mask_start,
+            BLOCK_N_SIZE,
+            False,
+            causal_mask,
+        )
+        acc, m_i, l_i = _attn_fwd_inner_block_ptr(
+            acc, m_i, l_i, q,
+            tl.advance(k_block_ptr, (0, mask_start)), tl.advance(v_block_ptr, (mask_start, 0)),
+            m_pos, n_range_offs,
+            n_size,
+            mask_start, end_n,
+            BLOCK_N_SIZE,
+            True,
+            causal_mask,
+        )
+
+        acc = acc / l_i[:, None] # 循环结束后统一归一化
+        o_block_ptr = tl.make_block_ptr(
+            base=o_ptr + cur_batch_idx * out_batch_stride + cur_head_idx * out_heads_stride,
+            shape=(q_rows, BLOCK_DHEAD_SIZE), strides=(out_seq_stride, out_dim_stride),
+            offsets=(block_m_idx * BLOCK_M_SIZE, 0), block_shape=(BLOCK_M_SIZE, BLOCK_DHEAD_SIZE), order=(1, 0),
+        )
+        tl.store(o_block_ptr, acc.to(o_ptr.dtype.element_ty), boundary_check=(0,))
+    else:
+        q_offs = (
+            cur_batch_idx * q_batch_stride
+            + cur_head_idx * q_heads_stride
+            + (m_offs[:, None] * q_seq_stride + dhead_range_offs[None, :] * q_dim_stride))
+
+        # K 直接按转置后的 [BLOCK_DHEAD_SIZE, BLOCK_N_SIZE] 布局加载, 省去循环内的 tl.trans
+        k_offs = (
+            cur_batch_idx * k_batch_stride
+            + cur_head_idx * k_heads_stride
+            + (dhead_range_offs[:, None] * k_dim_stride + n_range_offs[None, :] * k_seq_stride))
+
+        v_offs = (
+            cur_batch_idx * v_batch_stride
+            + cur_head_idx * v_heads_stride
+            + (n_range_offs[:, None] * v_seq_stride + dhead_range_offs[None, :] * v_dim_stride))
+
+        o_offs = (
+            cur_batch_idx * out_batch_stride
+            + cur_head_idx * out_heads_stride
+            + (m_offs[:, None] * out_seq_stride + dhead_range_offs[None, :] * out_dim_stride))
+
+        q_ptrs = q_ptr + q_offs
+        k_ptrs = k_ptr + k_offs
+        v_ptrs = v_ptr + v_offs
+        out_ptrs = o_ptr + o_offs
+
+        q_mask = m_offs[:, None] < q_rows
+        q = tl.load(q_ptrs, mask=q_mask, other=0.0)
+        # sm_scale 在循环外一次性折叠进 q, 省去每个 tile 上 qk 的一次乘法
+        q = (q * sm_scale).to(q_ptr.dtype.element_ty)
+
+        # 1. 无需 mask 的 K 块
+        acc, m_i, l_i = _attn_fwd_inner(
+            acc, m_i, l_i, q,
+            k_ptrs, v_ptrs,
+            k_seq_stride, v_seq_stride,
+            m_pos, n_range_offs,
+            n_size,
+            0, mask_start,
+            BLOCK_N_SIZE,
+            False,
+            causal_mask,
+        )
+        # 2. 对角线块(causal)或尾块(非 causal), 应用 mask
+        acc, m_i, l_i = _attn_fwd_inner(
+            acc, m_i, l_i, q,
+            k_ptrs, v_ptrs,
+            k_seq_stride, v_seq_stride,
+            m_pos, n_range_offs,
+            n_size,
+            mask_start, end_n,
+            BLOCK_N_SIZE,
+            True,
+            causal_mask,
+        )
+
+        acc = acc / l_i[:, None] # 循环结束后统一归一化
+        out_mask = m_offs[:, None] < q_rows
+        tl.store(out_ptrs, acc, mask=out_mask)
+
+@torch.no_grad()
+@custom_fwd(device_type='cuda', cast_inputs=torch.float16)
+def flash_attention_v1(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    sm_scale,
+    ):
+    """Compute Flash-attention, can't support fp32 input
+    参数:
+        q: Query tensor, shape: [bs, n_heads, m_size, head_dim], decode 阶段, q 的 seq_len 和 k v 不一致, 其值为 1
+        k: Key tensor,  shape: [bs, n_kv_heads, n_size, head_dim].
+        v: Value tensor, shape is consistent with k.
+        sm_scale: attention 分数缩放系数, 以 2 为底, 即 1/sqrt(head_dim) * log2(e)
+    """
+    BLOCK_SIZE = 64 # default: BLOCK_M_SIZE = BLOCK_N_SIZE = 64
+    assert q.shape[-1] == k.shape[-1] == v.shape[-1]
+    assert (
+            q.dtype == k.dtype == v.dtype
+        ), f"All tensors must have the same dtype: {q.dtype}, {k.dtype}, {v.dtype}"
+
+    bs, n_heads, m_size, HEAD_DIM = q.size()
+    n_kv_heads, n_size = k.shape[1], k.shape[2]
+    num_kv_groups = n_heads // n_kv_heads # num_q_heads // num_k_heads
+    causal_mask = m_size > 1 # prefill 阶段才需要 causal mask
+
+    # GQA: 同一 kv head 对应的 q heads 在 head 维连续, 折叠进 M 维, 一次 K/V 加载服务整组 q heads
+    # (bs, H, M, Hd)->(bs, KVH, G*M, Hd)
+    q = q.reshape(bs, n_kv_heads, num_kv_groups * m_size, HEAD_DIM)
+    q_rows = q.shape[2]
+    output = torch.empty_like(q)
+
+    grid = lambda meta: (triton.cdiv(q_rows, BLOCK_SIZE), bs * n_kv_heads, 1) # 二维 grid
+    # SM90 上走 block pointer 路径并使用 3 级流水; 注意当前 Triton 并不会把 block pointer 降级为 TMA 加载,
+    # 其余架构保持原有的指针运算路径和默认流水级数
+    use_block_ptr = torch.cuda.get_device_capability(q.device)[0] == 9
+    launch_kwargs = {"num_stages": 3} if use_block_ptr else {}
+
+    flash_attention_v1_kernel[grid](
+        q,
+        k,
+        v,
+        output,
+        *q.stride(),  # (batch, kv_heads, G*m_size, head_dim)
+        *k.stride(),  # (batch, kv_heads, n_size, head_dim)
+        *v.stride(),  # (batch, kv_heads, n_size, head_dim)
+        *output.stride(),  # (batch, kv_heads, G*m_size, head_dim)
+        n_kv_heads,
+        m_size,
+        q_rows,
+        n_size,
+        HEAD_DIM,
+        BLOCK_SIZE,  # BLOCK_M_SIZE
+        BLOCK_SIZE,  # BLOCK_N_SIZE
+        sm_scale,
+        causal_mask,
+        use_block_ptr,
+        **launch_kwargs,
+    )
+    return output.view(bs, n_heads, m_size, HEAD_DIM)
+
+def standard_attention(q, k, v, sm_scale):
+    """标准 attention 实现(纯 PyTorch 版), 用于精度验证"""
+    num_kv_groups = q.shape[1] // k.shape[1]
+    k = k.repeat_interleave(num_kv_groups, dim=1)
+    v = v.repeat_interleave(num_kv_groups, dim=1)
+    m_size, n_size = q.shape[2], k.shape[2]
+    scores = torch.matmul(q, k.transpose(2, 3)) * sm_scale
+    if m_size > 1:
+        mask = torch.tril(torch.ones((m_size, n_size), device=q.device, dtype=torch.bool))
+        scores = scores.masked_fill(~mask, float("-inf"))
+    scores = torch.softmax(scores.float(), dim=-1).to(q.dtype)
+    return torch.matmul(scores, v)
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    bs, n_heads, n_kv_heads, seq_len, head_dim = 2, 32, 8, 1024, 64
+    sm_scale = 1.0 / math.sqrt(head_dim) * 1.4426950408889634
+    q = torch.randn((bs, n_heads, seq_len, head_dim), device="cuda", dtype=torch.float16)
+    k = torch.randn((bs, n_kv_heads, seq_len, head_dim), device="cuda", dtype=torch.float16)
+    v = torch.randn((bs, n_kv_heads, seq_len, head_dim), device="cuda", dtype=torch.float16)
+
+    triton_output = flash_attention_v1(q, k, v, sm_scale)
+    torch_output = standard_attention(q, k, v, 1.0 / math.sqrt(head_dim))
+    print(f'The maximum difference between torch and triton is {torch.max(torch.abs(torch_output - triton_output))}')
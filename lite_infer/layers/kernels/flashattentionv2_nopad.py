@@ -7,6 +7,7 @@ import triton
 import triton.language as tl
 from torch.amp import custom_fwd
 # from torch.cuda.amp import custom_fwd
+from .utils import get_max_shared_mem
 
 configs_tma = [
     triton.Config({'BLOCK_M_SIZE': BM, 'BLOCK_N_SIZE': BN}, num_stages=stages, num_warps=warps) \
@@ -19,14 +20,96 @@ configs_tma = [
 def keep_tma(conf):
     BLOCK_M_SIZE = conf.kwargs["BLOCK_M_SIZE"]
     BLOCK_N_SIZE = conf.kwargs["BLOCK_N_SIZE"]
-    if (torch.cuda.get_device_capability()[0] == 9 and BLOCK_M_SIZE * BLOCK_N_SIZE < 128 * 128 and conf.num_warps == 8):
+    num_warps = conf.num_warps
+    capability = torch.cuda.get_device_capability()[0]
+    if (capability == 9 and BLOCK_M_SIZE * BLOCK_N_SIZE < 128 * 128 and num_warps == 8):
+        return False
+    # Hopper 之前的显卡 16 个 warp 寄存器不足, 不会是最优配置
+    if capability < 9 and num_warps == 16:
+        return False
+    # 每个 warp 至少分到 32 个元素, 且至少一行 Q
+    if BLOCK_M_SIZE * BLOCK_N_SIZE < num_warps * 32 or BLOCK_M_SIZE < num_warps:
         return False
     return True
 
-# 根据key['B_Seqlen', 'HEAD_DIM'] 参数, 进行BLOCK_M_SIZE, BLOCK_N_SIZE的调优
+def prune_by_shared_mem(configs, named_args, **kwargs):
+    # Q tile 常驻 shared memory, K V tile 按 num_stages 多级缓冲, 再加上 qk 分数 tile, fp16 每个元素 2 字节
+    head_dim = {**named_args, **kwargs}["HEAD_DIM"]
+    max_shared_mem = get_max_shared_mem()
+    def shared_mem(conf):
+        BLOCK_M_SIZE, BLOCK_N_SIZE = conf.kwargs["BLOCK_M_SIZE"], conf.kwargs["BLOCK_N_SIZE"]
+        return 2 * (BLOCK_M_SIZE * head_dim + conf.num_stages * 2 * BLOCK_N_SIZE * head_dim + BLOCK_M_SIZE * BLOCK_N_SIZE)
+    pruned = [conf for conf in configs if shared_mem(conf) <= max_shared_mem]
+    return pruned if pruned else [min(configs, key=shared_mem)]
+
+@triton.jit
+def _attn_fwd_inner(
+    acc, m_i, d_i, q,
+    k_ptrs, v_ptrs,
+    stride_k_bs, stride_v_bs,
+    offs_m, offs_n,
+    sm_scale,
+    start_loc, end_loc, # 本段循环处理的 K/V 序列范围 [start_loc, end_loc)
+    block_end_loc,
+    BLOCK_N_SIZE: tl.constexpr,
+    IS_DIAGONAL: tl.constexpr, # 对角线块需要 causal mask, 对角线以下的块 mask 全为 True, 无需计算
+):
+    # 每次循环按 BLOCK_N_SIZE 来处理 K, V 的列（即 key/value 的序列维度）。
+    for start_n in range(start_loc, end_loc, BLOCK_N_SIZE):
+        start_n = tl.multiple_of(start_n, BLOCK_N_SIZE)
+        # 计算 qk^t
+        if IS_DIAGONAL:
+            k = tl.load(
+                k_ptrs + start_n * stride_k_bs,
+                mask=(start_n + offs_n[None, :]) < block_end_loc, other = 0.0
+            )
+        else:
+            k = tl.load(k_ptrs + start_n * stride_k_bs)
+
+        qk = tl.dot(q, k)
+
+        if IS_DIAGONAL:
+            # 应用因果遮罩, 下三角矩阵 causal mask
+            casual_mask = offs_m[:, None] >= (start_n + offs_n[None, :])
+            qk = tl.where(casual_mask, qk*sm_scale, -1.0e8)
+        else:
+            qk = qk * sm_scale
+
+        m_ij = tl.maximum(m_i, tl.max(qk, 1)) # 求 qk 的最大值
+        qk -= m_ij[:, None]
+        p = tl.math.exp2(qk)  # qk - m_ij[:, None]更新为安全的 qk 分子项
+        d_ij = tl.sum(p, 1) # 1d vector
+
+        # -- 更新归一化项 d_new
+        alpha = tl.math.exp2(m_i - m_ij)
+        d_i = d_i * alpha + d_ij
+
+        # -- update output accumulator --
+        acc = acc * alpha[:, None] # acc scaling
+
+        # compute O = PV
+        if IS_DIAGONAL:
+            v = tl.load(
+                v_ptrs + start_n * stride_v_bs,
+                mask=(start_n + offs_n[:, None]) < block_end_loc,
+                other=0.0,
+            )
+        else:
+            v = tl.load(v_ptrs + start_n * stride_v_bs)
+        p = p.to(v.dtype)
+        acc = tl.dot(p, v, acc)
+
+        # update the normalizer (l and d) for next iteration
+        m_i = m_ij
+
+    return acc, m_i, d_i
+
+# 根据key['SEQ_LEN_BUCKET', 'HEAD_DIM'] 参数, 进行BLOCK_M_SIZE, BLOCK_N_SIZE的调优
+# 注意 key 不能是张量(如 B_Seqlen), 否则每次传入新张量都会重新 autotune
 @triton.autotune(
     configs=list(filter(keep_tma, configs_tma)), 
-    key=['B_Seqlen', 'HEAD_DIM']
+    key=['SEQ_LEN_BUCKET', 'HEAD_DIM'],
+    prune_configs_by={'early_config_prune': prune_by_shared_mem},
 )
 
 #gird(Tr, B*H, 1), 每个线程block处理一个序列的一个head的Br个token/序列
@@ -39,6 +122,7 @@ def flash_attentionv2_nopad_kernel(
     stride_k_bs, stride_k_heads, stride_k_dim,  # K 的 strides
     stride_v_bs, stride_v_heads, stride_v_dim,  # V 的 strides
     stride_o_bs, stride_o_heads, stride_o_dim,
+    SEQ_LEN_BUCKET, # next_power_of_2(max_seq_len), 仅作为 autotune 的 key, kernel 中不使用
     HEAD_DIM: tl.constexpr, # head_dim dimension
     BLOCK_M_SIZE: tl.constexpr, # BLOCK size of m_size dimension，即 Q 矩阵行数分成了m_size // BLOCK_M_SIZE 块，块大小是 BLOCK_M_SIZE, 由 autotune 自动选择
     BLOCK_N_SIZE: tl.constexpr, # BLOCK size of n_size dimension, 由 autotune 自动选择
@@ -79,8 +163,8 @@ def flash_attentionv2_nopad_kernel(
     k_offs = offs_n[None, :] * stride_k_bs + cur_kv_head_idx * stride_k_heads + offs_d[:, None] * stride_k_dim
     v_offs = offs_n[:, None] * stride_v_bs + cur_kv_head_idx * stride_v_heads + offs_d[None, :] * stride_v_dim
     
-    k_ptrs = K + k_offs
-    v_ptrs = V + v_offs
+    k_ptrs = K + cur_seq_start_loc * stride_k_bs + k_offs
+    v_ptrs = V + cur_seq_start_loc * stride_v_bs + v_offs
 
     # 初始化用于计算 softmax 归一化项的 m 和 d, 意义见 online-softmax, 这里
     m_i = tl.zeros((BLOCK_M_SIZE,), dtype=tl.float32) - float("inf")
@@ -89,45 +173,33 @@ def flash_attentionv2_nopad_kernel(
         
     block_mask = tl.where(block_start_loc < cur_seq_len, 1, 0)
     block_end_loc = tl.minimum(block_start_loc + BLOCK_M_SIZE, cur_seq_len)
+    # 对角线以下的 K 块 causal mask 全为 True, 对角线以上的 K 块全被遮住, 无需迭代
+    diag_start_loc = block_mask * (block_start_loc // BLOCK_N_SIZE) * BLOCK_N_SIZE
 
-    # 每次循环按 BLOCK_N_SIZE 来处理 K, V 的列（即 key/value 的序列维度）。
-    for start_n in range(0, block_mask * block_end_loc, BLOCK_N_SIZE):
-        start_n = tl.multiple_of(start_n, BLOCK_N_SIZE)
-        # 计算 qk^t
-        k = tl.load(
-            k_ptrs + (cur_seq_start_loc + start_n) * stride_k_bs,
-            mask=(start_n + offs_n[None, :]) < block_end_loc, other = 0.0
-        )
-
-        qk = tl.dot(q, k)
-        
-        # 应用因果遮罩, 下三角矩阵 causal mask 
-        casual_mask = offs_m[:, None] >= (start_n + offs_n[None, :])
-        qk = tl.where(casual_mask, qk*sm_scale, -1.0e8)
-
-        m_ij = tl.maximum(m_i, tl.max(qk, 1)) # 求 qk 的最大值
-        qk -= m_ij[:, None]
-        p = tl.math.exp2(qk)  # qk - m_ij[:, None]更新为安全的 qk 分子项
-        d_ij = tl.sum(p, 1) # 1d vector
-
-        # -- 更新归一化项 d_new
-        alpha = tl.math.exp2(m_i - m_ij)
-        d_i = d_i * alpha + d_ij
-        
-        # -- update output accumulator --
-        acc = acc * alpha[:, None] # acc scaling 
-
-        # compute O = PV
-        v = tl.load(
-            v_ptrs + (cur_seq_start_loc + start_n) * stride_v_bs,
-            mask=(start_n + offs_n[:, None]) < block_end_loc,
-            other=0.0,
-        )
-        p = p.to(v.dtype)
-        acc = tl.dot(p, v, acc)
-        
-        # update the normalizer (l and d) for next iteration
-        m_i = m_ij
+    # 1. 对角线以下的 K 块, 不计算 causal mask
+    acc, m_i, d_i = _attn_fwd_inner(
+        acc, m_i, d_i, q,
+        k_ptrs, v_ptrs,
+        stride_k_bs, stride_v_bs,
+        offs_m, offs_n,
+        sm_scale,
+        0, diag_start_loc,
+        block_end_loc,
+        BLOCK_N_SIZE,
+        False,
+    )
+    # 2. 对角线块, 应用 causal mask
+    acc, m_i, d_i = _attn_fwd_inner(
+        acc, m_i, d_i, q,
+        k_ptrs, v_ptrs,
+        stride_k_bs, stride_v_bs,
+        offs_m, offs_n,
+        sm_scale,
+        diag_start_loc, block_mask * block_end_loc,
+        block_end_loc,
+        BLOCK_N_SIZE,
+        True,
+    )
     
     acc = acc / d_i[:, None]
     off_o = (
@@ -151,6 +223,7 @@ def flash_attentionv2_no_pad(
     b_start_loc, 
     b_seq_len, 
     max_seq_len,
+    output=None,
     ):
     """Compute Flash-attention, can't support fp32 input
     参数:
@@ -159,10 +232,14 @@ def flash_attentionv2_no_pad(
         v: Value tensor, shape: [B*S, H, Hd]. 
         b_start_loc: (B, )
         b_seq_len: (B, )
+        output: 可选的预分配输出, shape: [B*S, H, Hd] 或 [B*S, H*Hd], 最后一维连续, kernel 直接写入
     """
-    output = torch.empty_like(q)
     batchs = b_seq_len.shape[0]
     n_heads, HEAD_DIM = q.shape[1], q.shape[2]
+    if output is None:
+        output = torch.empty_like(q)
+    else:
+        output = output.view(-1, n_heads, HEAD_DIM)
 
     num_kv_groups = q.shape[1] // k.shape[1] # num_q_heads // num_k_heads
     grid = lambda meta: (triton.cdiv(max_seq_len, meta["BLOCK_M_SIZE"]), batchs * n_heads, 1)
@@ -181,6 +258,7 @@ def flash_attentionv2_no_pad(
         k.stride(0), k.stride(1), k.stride(2),
         v.stride(0), v.stride(1), v.stride(2),
         output.stride(0), output.stride(1), output.stride(2),
+        triton.next_power_of_2(max_seq_len),
         HEAD_DIM=HEAD_DIM
     )
     return output
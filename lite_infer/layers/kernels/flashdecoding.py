@@ -1,7 +1,9 @@
+import functools
 import triton, torch
 import triton.language as tl
 from torch.amp import custom_fwd
 # from torch.cuda.amp import custom_fwd
+from .utils import get_max_shared_mem
 
 configs_tma = [
     triton.Config({'BLOCK_N': BN}, num_stages=stages, num_warps=warps) \
@@ -12,19 +14,42 @@ configs_tma = [
 
 def keep_tma(conf):
     BLOCK_N = conf.kwargs["BLOCK_N"]
-    if (torch.cuda.get_device_capability()[0] == 9 and BLOCK_N < 128 and conf.num_warps == 8):
+    capability = torch.cuda.get_device_capability()[0]
+    if (capability == 9 and BLOCK_N < 128 and conf.num_warps == 8):
+        return False
+    # Hopper 之前的显卡 16 个 warp 寄存器不足, 不会是最优配置
+    if capability < 9 and conf.num_warps == 16:
         return False
     return True
 
-# 根据key['B_Seqlen', 'BLOCK_DMODEL'] 参数, 进行BLOCK_N的调优
+def prune_block_n(configs, named_args, **kwargs):
+    args = {**named_args, **kwargs}
+    block_seq, block_h, head_dim = args["BLOCK_SEQ"], args["BLOCK_H"], args["BLOCK_DMODEL"]
+    max_shared_mem = get_max_shared_mem()
+    def keep(conf):
+        BLOCK_N, num_warps = conf.kwargs["BLOCK_N"], conf.num_warps
+        # BLOCK_N 大于分区长度时多出的部分全部被 mask
+        if BLOCK_N > block_seq:
+            return False
+        # (BLOCK_H, BLOCK_N) 的 qk tile 每个 warp 至少分到 32 个元素, 且至少一行 Q
+        if block_h * BLOCK_N < num_warps * 32 or block_h < num_warps:
+            return False
+        # K V tile 按 num_stages 多级缓冲, fp16 每个元素 2 字节
+        return 2 * (block_h * head_dim + conf.num_stages * 2 * BLOCK_N * head_dim) <= max_shared_mem
+    pruned = [conf for conf in configs if keep(conf)]
+    return pruned if pruned else configs[:1]
+
+# 根据 key['BLOCK_SEQ', 'BLOCK_H', 'BLOCK_DMODEL'] 参数, 进行 BLOCK_N 的调优
 @triton.autotune(
     configs=list(filter(keep_tma, configs_tma)), 
-    key=['B_Seqlen', 'q_dim_stride']
+    key=['BLOCK_SEQ', 'BLOCK_H', 'BLOCK_DMODEL', 'KV_QUANT'],
+    prune_configs_by={'early_config_prune': prune_block_n},
 )
-# grid(B, H, S//partition_size)
+# grid(B, KVH, S//partition_size), 同一个 kv head 对应的 num_kv_groups 个 q head 折叠成一个 (BLOCK_H, Hd) 的 Q tile
 @triton.jit
 def _flash_decoding_stage1_kernel(
-    Q, K, V, qk_scale, # Q: [B, H, Hd], K, V: [B*S, H, Hd]
+    Q, K, V, qk_scale, # Q: [B, H, Hd], K, V: [B*S, KVH, Hd]
+    K_Scale, V_Scale, # int8 kv cache 的反量化系数: [B*S, KVH]
     b_req_tokens_table, B_Seqlen, # (B, S), (B, )
 	num_kv_groups, # group of kv heads
     Mid_O, Mid_O_LogExpSum, # Mid_O: [B, H, S//PARTITION_SIZE, Hd], Mid_O_LogExpSum: [B, H, S//PARTITION_SIZE]
@@ -32,22 +57,28 @@ def _flash_decoding_stage1_kernel(
     q_bs_stride, q_heads_stride, q_dim_stride,  # Q 的 strides
     k_bs_stride, k_heads_stride, k_dim_stride,  # K 的 strides
     v_bs_stride, v_heads_stride, v_dim_stride,  # V 的 strides
+    ks_bs_stride, vs_bs_stride, # K_Scale, V_Scale 的 token 维 stride
     mido_batch_stride, mido_heads_stride, mido_partitions_stride, mido_dim_stride,
     mido_les_batch_stride, mido_les_heads_stride, mido_les_partitions_stride,
-    BLOCK_SEQ: tl.constexpr, # 默认 128
+    BLOCK_SEQ: tl.constexpr, # 分区长度, 由 flash_decoding 按 SM 数量选取
     BLOCK_N: tl.constexpr,   # 默认 32, autotune
-    BLOCK_DMODEL: tl.constexpr
+    BLOCK_DMODEL: tl.constexpr,
+    BLOCK_H: tl.constexpr, # max(16, next_power_of_2(num_kv_groups)), tl.dot 要求 M 维不小于 16
+    KV_QUANT: tl.constexpr, # K V 为 int8 时加载后乘以反量化系数
 ):
     """Flash Attention Stage1 Triton Kernel"""
     # 获取当前程序的 block 在各个维度上的索引
     batch_pid = tl.program_id(0)
-    head_pid = tl.program_id(1)
+    kv_head_pid = tl.program_id(1)
     seq_block_pid = tl.program_id(2)
-    kv_head_pid = head_pid // num_kv_groups
 
-    # 计算当前批次的起始位置
+    # 当前 kv head 对应的 q heads: [kv_head_pid * num_kv_groups, (kv_head_pid + 1) * num_kv_groups)
+    offs_h = tl.arange(0, BLOCK_H)
+    mask_h = offs_h < num_kv_groups
+    cur_heads = kv_head_pid * num_kv_groups + offs_h
+
+    # 计算当前批次的序列长度
     cur_batch_seq_len = tl.load(B_Seqlen + batch_pid) # B_Seqlen[batch_pid]
-    cur_req_start_loc = tl.load(b_req_tokens_table + stride_req_to_tokens_b * batch_pid) # b_req_tokens_table[stride_req_to_tokens_b, :]
 
     # 计算当前分区的起始和结束索引
     cur_batch_partition_start_index = seq_block_pid * BLOCK_SEQ
@@ -61,98 +92,116 @@ def _flash_decoding_stage1_kernel(
     offs_n = cur_batch_partition_start_index + tl.arange(0, BLOCK_N)  # 0~BLOCK_N
     offs_d = tl.arange(0, BLOCK_DMODEL)  # 0~BLOCK_DMODEL
 
-    # 计算 Q K 的偏移量
+    # 加载 Q tile: Q[batch_pid, cur_heads, :], (BLOCK_H, Hd)
     q_offs = (
         batch_pid * q_bs_stride 
-        + head_pid * q_heads_stride
-        + offs_d * q_dim_stride
-    ) # Q[batch_pid, head_pid, :]
-    k_offs = kv_head_pid * k_heads_stride + offs_d[None, :] * k_dim_stride # K[:, kv_head_pid, :]
+        + cur_heads[:, None] * q_heads_stride
+        + offs_d[None, :] * q_dim_stride
+    )
+    q = tl.load(Q + q_offs, mask=mask_h[:, None], other=0.0)
 
-    q_ptrs = Q + q_offs # 获取 Q 指针 Q[batch_pid, head_pid, :]
-    q = tl.load(q_ptrs)  # # 加载 Q 向量
+    k_offs = kv_head_pid * k_heads_stride + offs_d[None, :] * k_dim_stride # K[:, kv_head_pid, :]
+    v_offs = kv_head_pid * v_heads_stride + offs_d[None, :] * v_dim_stride # V[:, kv_head_pid, :]
 
     # 初始化归一化项和累加器
-    d_i = 1e-8  # 标量 # 使用小的正数而不是0
-    m_i = -float("inf")  # 标量
-    acc = tl.zeros([BLOCK_DMODEL], dtype=tl.float32)  # (BLOCK_DMODEL, )
+    d_i = tl.zeros([BLOCK_H], dtype=tl.float32)
+    m_i = tl.zeros([BLOCK_H], dtype=tl.float32) - float("inf")
+    acc = tl.zeros([BLOCK_H, BLOCK_DMODEL], dtype=tl.float32)  # (BLOCK_H, BLOCK_DMODEL)
     # 迭代处理每个块
     for start_n in range(0, num_blocks, 1):
         # k 位置索引计算
         offs_n_new = offs_n + start_n * BLOCK_N  # BLOCK_Seq[start_n]
-        # b_req_tokens_table[batch_pid, start_n*BLOCK_N:start_n*BLOCK_N + BLOCK_N]
-        k_loc = tl.load(b_req_tokens_table + stride_req_to_tokens_b * batch_pid + offs_n_new, mask=offs_n_new < cur_batch_partition_end_index, other=0.0)
-        k_ptrs = k_loc[:, None] * k_bs_stride + k_offs # K[batch_pid, start_n*BLOCK_N:start_n*BLOCK_N + BLOCK_N, kv_head_pid, :]
-        
         k_mask = offs_n_new < cur_batch_partition_end_index  # (BLOCK_N, )
+        # b_req_tokens_table[batch_pid, start_n*BLOCK_N:start_n*BLOCK_N + BLOCK_N]
+        k_loc = tl.load(b_req_tokens_table + stride_req_to_tokens_b * batch_pid + offs_n_new, mask=k_mask, other=0).to(tl.int64)
         
-        k = tl.load(K + k_ptrs, mask=k_mask[:, None], other=0.0) # K[batch_pid, start_n*BLOCK_N:start_n*BLOCK_N + BLOCK_N, kv_head_pid, :]
-        v = tl.load(V + k_ptrs, mask=k_mask[:, None], other=0.0) # V[batch_pid, start_n*BLOCK_N:start_n*BLOCK_N + BLOCK_N, kv_head_pid, :]
+        k = tl.load(K + k_loc[:, None] * k_bs_stride + k_offs, mask=k_mask[:, None], other=0.0) # (BLOCK_N, Hd)
+        v = tl.load(V + k_loc[:, None] * v_bs_stride + v_offs, mask=k_mask[:, None], other=0.0) # (BLOCK_N, Hd)
+        if KV_QUANT:
+            k_s = tl.load(K_Scale + k_loc * ks_bs_stride + kv_head_pid, mask=k_mask, other=0.0) # (BLOCK_N, )
+            v_s = tl.load(V_Scale + k_loc * vs_bs_stride + kv_head_pid, mask=k_mask, other=0.0) # (BLOCK_N, )
+            k = (k.to(tl.float32) * k_s[:, None]).to(q.dtype)
+            v = (v.to(tl.float32) * v_s[:, None]).to(q.dtype)
         
         # 计算 qk^T
-        qk = tl.sum(q[None, :] * k, axis=1)  # (1, Hd)@(Hd, BLOCK_N)->(1, BLOCK_N)
+        qk = tl.dot(q, tl.trans(k))  # (BLOCK_H, Hd)@(Hd, BLOCK_N)->(BLOCK_H, BLOCK_N)
         qk *= qk_scale
-        qk = tl.where(k_mask, qk, float("-inf"))  # (1, BLOCK_N)
+        qk = tl.where(k_mask[None, :], qk, float("-inf"))  # (BLOCK_H, BLOCK_N)
 
         # 更新最大值项和 qk 项
-        current_max = tl.max(qk)  # 标量
-        m_ij = tl.maximum(m_i, current_max)  # 标量
-        p = tl.exp(qk - m_ij)  # (1, BLOCK_N)
+        m_ij = tl.maximum(m_i, tl.max(qk, axis=1))  # (BLOCK_H, )
+        p = tl.exp2(qk - m_ij[:, None])  # (BLOCK_H, BLOCK_N), qk_scale 已乘 log2(e)
         
         # 更新归一化项
-        alpha = tl.exp(m_i - m_ij) # 标量
-        d_i = alpha * d_i + tl.sum(p, axis=0) # 标量
+        alpha = tl.exp2(m_i - m_ij) # (BLOCK_H, )
+        d_i = alpha * d_i + tl.sum(p, axis=1) # (BLOCK_H, )
 
         # 更新 attention 输出累加器
-        acc = alpha * acc + tl.sum(p[:, None] * v, axis=0)  # (1, BLOCK_DMODEL)
-        # acc = acc * alpha + tl.dot(p, v)  # [BLOCK_DMODEL]
+        acc = acc * alpha[:, None] + tl.dot(p.to(v.dtype), v)  # (BLOCK_H, BLOCK_N)@(BLOCK_N, Hd)->(BLOCK_H, Hd)
         
         # 更新归一化器
         m_i = m_ij
-        
-    # 计算是否需要存储
-    need_store = num_blocks > 0  # 标量布尔值
 
     # 计算存储的偏移量
     off_mid_o = (
         batch_pid * mido_batch_stride
-        + head_pid * mido_heads_stride
+        + cur_heads[:, None] * mido_heads_stride
         + seq_block_pid * mido_partitions_stride
-        + offs_d * mido_dim_stride
-    ) # O[batch_pid, head_pid, seq_block_pid, :]
+        + offs_d[None, :] * mido_dim_stride
+    ) # O[batch_pid, cur_heads, seq_block_pid, :]
 
     off_mid_o_les = (
         batch_pid * mido_les_batch_stride
-        + head_pid * mido_les_heads_stride
+        + cur_heads * mido_les_heads_stride
         + seq_block_pid * mido_les_partitions_stride
-    ) # O[batch_pid, head_pid, seq_block_pid]
+    ) # O[batch_pid, cur_heads, seq_block_pid]
 
-    # 计算最终的 attention 输出和 log-sum-exp
-    need_store = tl.where(num_blocks == 0, 0, 1)
-    for _ in range(0, need_store, 1):
-        tl.store(Mid_O + off_mid_o, acc / d_i)
-        tl.store(Mid_O_LogExpSum + off_mid_o_les, m_i + tl.log(d_i))
+    # 计算最终的 attention 输出和 log-sum-exp, 空分区不存储
+    if num_blocks > 0:
+        tl.store(Mid_O + off_mid_o, acc / d_i[:, None], mask=mask_h[:, None])
+        tl.store(Mid_O_LogExpSum + off_mid_o_les, m_i + tl.log2(d_i), mask=mask_h) # 以 2 为底的 log-sum-exp
+
+@functools.lru_cache
+def _get_num_sms(device_index):
+    return torch.cuda.get_device_properties(device_index).multi_processor_count
+
+def get_partition_size(batchs, num_kv_heads, max_actual_seq_len, device):
+    """
+    选取 kv 分区长度: stage1 的 grid 为 (B, KVH, num_partitions), 让 program 数至少为 SM 数的 2 倍,
+    bs 较小、上下文较长时切得更细以占满 SM, bs 较大时分区变长以减少 stage2 的归约开销。
+    """
+    device_index = device.index if device.index is not None else torch.cuda.current_device()
+    num_splits = triton.cdiv(2 * _get_num_sms(device_index), batchs * num_kv_heads)
+    partition_size = triton.next_power_of_2(triton.cdiv(max_actual_seq_len, num_splits))
+    return min(max(partition_size, 64), 4096)
 
 @torch.no_grad()
 def flash_decode_stage1(
-    q, k, v,         		# Q: [B, H, Hd], K, V: [B*S, H, Hd]
+    q, k, v,         		# Q: [B, H, Hd], K, V: [B*S, KVH, Hd]
     qk_scale, 
     b_req_tokens_table, # (B, S)
 	b_seq_len, # (B, )
 	max_actual_seq_len,     # 最大的实际序列长度
     mid_o, mid_o_logexpsum, # Mid_O: [B, H, S//PARTITION_SIZE, Hd], Mid_O_LogExpSum: [B, H, S//PARTITION_SIZE]
     PARTITION_SIZE,
+    k_scale=None, v_scale=None, # int8 kv cache 的反量化系数: [B*S, KVH]
 ):
-	# assert PARTITION_SIZE % BLOCK_N_SIZE == 0, "PARTITION_SIZE 必须是 BLOCK_N_SIZE 的倍数"
-
 	batchs, num_heads, head_dim = q.shape[0], q.shape[1], q.shape[2] # decode 阶段 q 张量的 seq_len = 1, 这里的 batchs 实际就是 batch_size
+	num_kv_heads = k.shape[1]
+	num_kv_groups = num_heads // num_kv_heads # num_q_heads // num_k_heads
 	
-	# grid 配置的并行度比 flashattention1-2 多了 kv cache seq 维度
-	grid = (batchs, num_heads, triton.cdiv(max_actual_seq_len + PARTITION_SIZE - 1, PARTITION_SIZE))
-	num_kv_groups = q.shape[1] // k.shape[1] # num_q_heads // num_k_heads
+	# grid 配置的并行度比 flashattention1-2 多了 kv cache seq 维度, GQA 的一组 q heads 由同一个 program 处理
+	grid = (batchs, num_kv_heads, triton.cdiv(max_actual_seq_len, PARTITION_SIZE))
+	kv_quant = k.dtype == torch.int8
+	if kv_quant:
+		assert k_scale is not None and v_scale is not None
+		assert k_scale.shape == v_scale.shape == k.shape[:2] and k_scale.stride(-1) == v_scale.stride(-1) == 1
+	else:
+		k_scale, v_scale = mid_o_logexpsum, mid_o_logexpsum # 占位, kernel 中不使用
 
 	_flash_decoding_stage1_kernel[grid](
 		q, k, v, qk_scale,
+		k_scale, v_scale,
 	   	b_req_tokens_table,
         b_seq_len, 
 		num_kv_groups,   # kv 组数量
@@ -161,10 +210,13 @@ def flash_decode_stage1(
 		*q.stride(),
 		*k.stride(),
 		*v.stride(),
+		k_scale.stride(0), v_scale.stride(0),
 		*mid_o.stride(),
 		*mid_o_logexpsum.stride(),
 		BLOCK_SEQ = PARTITION_SIZE,
 		BLOCK_DMODEL = head_dim,
+		BLOCK_H = max(16, triton.next_power_of_2(num_kv_groups)),
+		KV_QUANT = kv_quant,
 	)
 
 # gird(B, H)
@@ -213,11 +265,11 @@ def _flash_decoding_stage2_kernel(
 
         # -- 更新局部最大值 -- #
         m_ij = tl.maximum(part_max, m_i) # 标量
-        # -- 计算 alpha = exp(m{j-1} - m{j}) 值 -- #
-        alpha = tl.exp(m_i - m_ij) # 标量
+        # -- 计算 alpha = exp2(m{j-1} - m{j}) 值, stage1 的 log-sum-exp 以 2 为底 -- #
+        alpha = tl.exp2(m_i - m_ij) # 标量
 
         # -- 更新归一化项和 attention 输出累加器 -- #
-        p = tl.exp(part_max - m_ij) # 标量
+        p = tl.exp2(part_max - m_ij) # 标量
         acc = alpha * acc + p * part_v # (Hd, )
 
         # alpha * d_i: 缩放 d_i, p * weight: 当前元素的指数值 * 权重
@@ -256,14 +308,16 @@ def flash_decode_stage2(
 def flash_decoding(
     q, 			 # q 查询向量，形状为 [bsz, num_head, head_dim]
     k_cache, v_cache, 	     # 键/值向量缓存，形状为 [max_tokens, kv_num_head, head_dim]
-    qk_scale,
+    qk_scale,    # 以 2 为底的缩放系数, 即 1/sqrt(head_dim) * log2(e)
     b_req_tokens_table, b_seq_len, # start locations and sequence lengths for kv cache in a batch: (B, S), (B, )
-    max_actual_seq_len
+    max_actual_seq_len,
+    k_scale=None, v_scale=None, # k_cache/v_cache 为 int8 时的反量化系数, 形状为 [max_tokens, kv_num_head]
+    output=None, # 可选的预分配输出, 形状为 [bsz, num_head, head_dim] 或 [bsz, num_head * head_dim]
 ):
 	# q.view(-1, num_heads, head_dim)
 	assert q.shape[-1] == k_cache.shape[-1] == v_cache.shape[-1]
-	PARTITION_SIZE = 128  # 3090ti 显卡以上可设置为 256
 	batchs, num_heads, head_dim = q.shape # decode 阶段 q 的 seq_len = 1, 
+	PARTITION_SIZE = get_partition_size(batchs, k_cache.shape[1], max_actual_seq_len, q.device)
 
 	# 最大可用分区数量计算
 	max_num_partitions = (max_actual_seq_len + PARTITION_SIZE -1) // PARTITION_SIZE
@@ -275,9 +329,9 @@ def flash_decoding(
 	# decode stage 1: attention in partitions
 	flash_decode_stage1(q, k_cache, v_cache, qk_scale, 
                         b_req_tokens_table, b_seq_len, max_actual_seq_len, 
-                        mid_o, mid_o_logexpsum, PARTITION_SIZE)
+                        mid_o, mid_o_logexpsum, PARTITION_SIZE, k_scale, v_scale)
 	# decode stage 2: reduction among partitions
-	atten_output = torch.empty_like(q)
+	atten_output = torch.empty_like(q) if output is None else output.view(batchs, num_heads, head_dim)
 
 	flash_decode_stage2(mid_o, mid_o_logexpsum, atten_output, b_seq_len, PARTITION_SIZE)
      
@@ -331,7 +385,7 @@ def plot_performance_comparison(token_sizes, warmup_iterations=10, test_iteratio
     batch = 4
     num_heads = 32
     head_dim = 64
-    qk_scale = 1.0 / (head_dim ** 0.5)
+    qk_scale = 1.0 / (head_dim ** 0.5) * 1.4426950408889634 # flash_decoding 使用以 2 为底的缩放系数
     q = torch.randn(batch*1, num_heads, head_dim, device=device)
 
     flash_times = []
@@ -401,7 +455,7 @@ def main():
     num_heads = 32
     head_dim = 64
     max_tokens = 2048 # 每个请求序列的最大 tokens 长度
-    qk_scale = 1.0 / (head_dim ** 0.5)
+    qk_scale = 1.0 / (head_dim ** 0.5) * 1.4426950408889634 # flash_decoding 使用以 2 为底的缩放系数
 
     # 构造测试数据：固定 q，k_cache, v_cache, b_req_tokens_table, b_seq_len
     # 输入张量 q/k/v 的形状为 [batch * seq_len, num_heads, head_dim], 形状是三维的，为了兼容 flash_decoding 内核
@@ -423,6 +477,21 @@ def main():
     else:
         diff = (flash_out - standard_out).abs().max().item()
         print(f"验证失败：最大误差为 {diff:.4f}")
+
+    # int8 kv cache: 与反量化后的标准 Attention 对比
+    k_scale = k_cache.abs().amax(dim=-1).clamp(min=1e-6) / 127.0 # [max_tokens, num_heads]
+    v_scale = v_cache.abs().amax(dim=-1).clamp(min=1e-6) / 127.0
+    k_int8 = torch.round(k_cache / k_scale.unsqueeze(-1)).to(torch.int8)
+    v_int8 = torch.round(v_cache / v_scale.unsqueeze(-1)).to(torch.int8)
+    flash_out = flash_decoding(q, k_int8, v_int8, qk_scale, b_req_tokens_table, b_seq_len, max_tokens, k_scale, v_scale)
+    standard_out = torch_attention_with_kvcache(
+        q, k_int8.float() * k_scale.unsqueeze(-1), v_int8.float() * v_scale.unsqueeze(-1), b_start_loc, b_seq_len
+    )
+    if torch.allclose(flash_out, standard_out, atol=1e-3, rtol=1e-3):
+        print("验证通过: int8 kv cache Flash Decoding 输出与标准 Attention 接近。")
+    else:
+        diff = (flash_out - standard_out).abs().max().item()
+        print(f"int8 kv cache 验证失败：最大误差为 {diff:.4f}")
     
     # 封装的性能对比曲线函数
     token_numbers = [64, 128, 256, 512, 1024, max_tokens]
@@ -0,0 +1,255 @@
+import torch
+import triton
+import triton.language as tl
+
+# grid(num_tokens, H + KVH, 1) 或写 k/v_buffer 时 grid(num_tokens, H + 2*KVH, 1), 每个线程 block 处理一个 token 的一个 head
+@triton.jit
+def _fused_qkv_rope_kernel(
+    QKV,  # 打包的 QKV 张量, (num_tokens, (H + 2*KVH) * Hd), 依次为 q heads, k heads, v heads
+    Cos, Sin, # (cos_rows, Hd)
+    Position_Ids, # (num_tokens, ), HAS_POSITION_IDS 时 Cos/Sin 为按位置预计算的整张表, 在 kernel 内按位置取行
+    Inv_Freq, # (Hd//2, ), HAS_INV_FREQ 时超出 cos/sin 表的位置由 inv_freq 现场计算
+    K_Buffer, V_Buffer, # (max_num_tokens, KVH, Hd), fp16/bf16 或 int8
+    K_Scale, V_Scale, # (max_num_tokens, KVH), int8 kv cache 每个 token 每个 head 的反量化系数
+    Select_Index, # (num_tokens, ), 每个 token 写入 K_Buffer/V_Buffer 的行索引
+    stride_qkv_t, # (H + 2*KVH) * Hd
+    stride_cos_t, stride_sin_t, # Hd
+    stride_kb_bs, stride_kb_h, # KVH*Hd, Hd
+    stride_vb_bs, stride_vb_h, # KVH*Hd, Hd
+    stride_ks_bs, stride_vs_bs, # KVH, KVH
+    cos_rows, # cos 的行数, 为 num_tokens 或 seq_len(batch 维广播)
+    attention_scaling, # 现场计算时 cos/sin 的缩放系数, 与预计算表一致
+    num_q_heads, num_kv_heads,
+    HEAD_DIM: tl.constexpr,
+    BLOCK_HALF: tl.constexpr, # next_power_of_2(Hd // 2)
+    HAS_KV_BUFFER: tl.constexpr,
+    KV_QUANT: tl.constexpr, # k_buffer/v_buffer 为 int8 时写入前做对称量化
+    HAS_POSITION_IDS: tl.constexpr,
+    HAS_INV_FREQ: tl.constexpr,
+):
+    token_idx = tl.program_id(0)
+    head_idx = tl.program_id(1) # [0, H) 为 q heads, [H, H+KVH) 为 k heads, [H+KVH, H+2*KVH) 为 v heads
+
+    half_offs = tl.arange(0, BLOCK_HALF)
+    half_mask = half_offs < HEAD_DIM // 2
+
+    # cos/sin 的前后两半相同, 只需加载前一半
+    if HAS_POSITION_IDS:
+        pos = tl.load(Position_Ids + token_idx).to(tl.int64)
+        if not HAS_INV_FREQ:
+            tl.device_assert(pos < cos_rows, "position_ids out of range of the cos/sin table") # 仅 TRITON_DEBUG=1 时生效
+        cos_row_idx = tl.minimum(pos, cos_rows - 1) # 越界位置不读表外内存
+    else:
+        cos_row_idx = token_idx % cos_rows
+    cos = tl.load(Cos + cos_row_idx * stride_cos_t + half_offs, mask=half_mask, other=0.0).to(tl.float32)
+    sin = tl.load(Sin + cos_row_idx * stride_sin_t + half_offs, mask=half_mask, other=0.0).to(tl.float32)
+    if HAS_POSITION_IDS and HAS_INV_FREQ:
+        if pos >= cos_rows: # 超出预计算表的位置按 pos * inv_freq 现场计算, 与表的 fp32 计算方式一致
+            inv_freq = tl.load(Inv_Freq + half_offs, mask=half_mask, other=0.0).to(tl.float32)
+            freqs = pos.to(tl.float32) * inv_freq
+            cos = tl.cos(freqs) * attention_scaling
+            sin = tl.sin(freqs) * attention_scaling
+
+    x_ptrs = QKV + token_idx * stride_qkv_t + head_idx * HEAD_DIM + half_offs
+    x0 = tl.load(x_ptrs, mask=half_mask, other=0.0).to(tl.float32)
+    x1 = tl.load(x_ptrs + HEAD_DIM // 2, mask=half_mask, other=0.0).to(tl.float32)
+
+    # v heads 不做旋转, 等价于 cos = 1, sin = 0
+    is_rope_head = head_idx < num_q_heads + num_kv_heads
+    cos = tl.where(is_rope_head, cos, 1.0)
+    sin = tl.where(is_rope_head, sin, 0.0)
+
+    # rotate_half: [x0, x1] -> [x0*cos - x1*sin, x1*cos + x0*sin]
+    y0_fp32 = x0 * cos - x1 * sin
+    y1_fp32 = x1 * cos + x0 * sin
+    y0 = y0_fp32.to(QKV.dtype.element_ty)
+    y1 = y1_fp32.to(QKV.dtype.element_ty)
+    if is_rope_head:
+        tl.store(x_ptrs, y0, mask=half_mask)
+        tl.store(x_ptrs + HEAD_DIM // 2, y1, mask=half_mask)
+
+    # k heads 写入 k_buffer, v heads 写入 v_buffer
+    if HAS_KV_BUFFER:
+        if head_idx >= num_q_heads:
+            dest_index = tl.load(Select_Index + token_idx).to(tl.int64)
+            kv_mask = half_mask & (dest_index >= 0) # 行索引为负(decode batch 补齐的 pad 行)时不写入
+            if is_rope_head:
+                kv_head_idx = head_idx - num_q_heads
+                o_ptrs = K_Buffer + dest_index * stride_kb_bs + kv_head_idx * stride_kb_h + half_offs
+                s_ptr = K_Scale + dest_index * stride_ks_bs + kv_head_idx
+            else:
+                kv_head_idx = head_idx - num_q_heads - num_kv_heads
+                o_ptrs = V_Buffer + dest_index * stride_vb_bs + kv_head_idx * stride_vb_h + half_offs
+                s_ptr = V_Scale + dest_index * stride_vs_bs + kv_head_idx
+
+            if KV_QUANT:
+                # 每个 token 每个 head 一个 absmax 系数, 四舍五入到 [-127, 127]
+                amax = tl.maximum(tl.max(tl.abs(y0_fp32), axis=0), tl.max(tl.abs(y1_fp32), axis=0))
+                scale = tl.maximum(amax, 1e-6) / 127.0
+                q0 = y0_fp32 / scale
+                q1 = y1_fp32 / scale
+                q0 = tl.where(q0 >= 0, q0 + 0.5, q0 - 0.5).to(tl.int8)
+                q1 = tl.where(q1 >= 0, q1 + 0.5, q1 - 0.5).to(tl.int8)
+                tl.store(o_ptrs, q0, mask=kv_mask)
+                tl.store(o_ptrs + HEAD_DIM // 2, q1, mask=kv_mask)
+                tl.store(s_ptr, scale.to(s_ptr.dtype.element_ty), mask=dest_index >= 0)
+            else:
+                tl.store(o_ptrs, y0.to(o_ptrs.dtype.element_ty), mask=kv_mask)
+                tl.store(o_ptrs + HEAD_DIM // 2, y1.to(o_ptrs.dtype.element_ty), mask=kv_mask)
+
+@torch.no_grad()
+def fused_qkv_rope(
+    qkv, cos, sin, num_q_heads, num_kv_heads, head_dim,
+    k_buffer=None, v_buffer=None, select_index=None,
+    k_scale=None, v_scale=None,
+    position_ids=None,
+    inv_freq=None, attention_scaling=1.0,
+):
+    """
+    对一次 GEMM 得到的打包 QKV 原地应用旋转位置编码, 省去单独的 rope 内核对 Q K 的一次 HBM 读写。
+    传入 k_buffer/v_buffer 时同时把旋转后的 K 和 V 分别写入 k_buffer[select_index], v_buffer[select_index]。
+    参数:
+        qkv: (num_tokens, (H + 2*KVH) * Hd), 最后一维连续。
+        cos, sin: (B, S, Hd) 或 (1, S, Hd); 传入 position_ids 时为预计算的 cos/sin 表 (max_seq_len, Hd)。
+        k_buffer, v_buffer: (max_num_tokens, KVH, Hd), 可选。为 torch.int8 时写入前按 token 和 head 做 absmax 量化。
+        select_index: (num_tokens, ), k_buffer/v_buffer 不为 None 时必须提供; 值为负的 token 不写入缓存。
+        k_scale, v_scale: (max_num_tokens, KVH), int8 kv cache 的反量化系数, k_buffer 为 int8 时必须提供。
+        position_ids: (B, S) 或 (1, S)(batch 维广播), 可选。每个 token 的位置, kernel 内直接从 cos/sin 表中取对应行,
+            无需先 gather 出 (B, S, Hd)。
+        inv_freq: (Hd//2, ) fp32, 可选。传入时位置不小于 cos/sin 表行数的 token 按 pos * inv_freq 现场计算 cos/sin
+            (再乘以 attention_scaling); 未传入时位置必须小于表的行数。
+    输出:
+        xq: (num_tokens, H, Hd), xk: (num_tokens, KVH, Hd), xv: (num_tokens, KVH, Hd), 均为 qkv 上的视图, Q K 已旋转。
+    """
+    num_tokens = qkv.shape[0]
+    assert qkv.stride(-1) == 1 and qkv.shape[-1] == (num_q_heads + 2 * num_kv_heads) * head_dim
+    cos = cos.reshape(-1, head_dim) # (B*S, Hd), (S, Hd) 或 (max_seq_len, Hd)
+    sin = sin.reshape(-1, head_dim)
+    has_position_ids = position_ids is not None
+    if has_position_ids:
+        if position_ids.dim() == 2 and position_ids.shape[0] == 1 and position_ids.shape[1] != num_tokens:
+            position_ids = position_ids.expand(num_tokens // position_ids.shape[1], -1) # (1, S)->(B, S)
+        position_ids = position_ids.reshape(-1)
+        assert position_ids.shape[0] == num_tokens
+    else:
+        position_ids = qkv # 占位, kernel 中不使用
+    has_inv_freq = has_position_ids and inv_freq is not None
+    if has_inv_freq:
+        assert inv_freq.numel() == head_dim // 2 and inv_freq.is_contiguous()
+    else:
+        inv_freq = cos # 占位, kernel 中不使用
+
+    has_kv_buffer = k_buffer is not None
+    kv_quant = has_kv_buffer and k_buffer.dtype == torch.int8
+    if has_kv_buffer:
+        assert v_buffer is not None and select_index is not None and select_index.shape[0] == num_tokens
+        assert k_buffer.shape[1:] == v_buffer.shape[1:] == (num_kv_heads, head_dim)
+        assert k_buffer.stride(-1) == v_buffer.stride(-1) == 1 and k_buffer.dtype == v_buffer.dtype
+        grid = (num_tokens, num_q_heads + 2 * num_kv_heads)
+    else:
+        grid = (num_tokens, num_q_heads + num_kv_heads)
+        k_buffer, v_buffer, select_index = qkv, qkv, qkv # 占位, kernel 中不使用
+    if kv_quant:
+        assert k_scale is not None and v_scale is not None and k_scale.dtype == v_scale.dtype
+        assert k_scale.shape == v_scale.shape == k_buffer.shape[:2] and k_scale.stride(-1) == v_scale.stride(-1) == 1
+    else:
+        k_scale, v_scale = cos, cos # 占位, kernel 中不使用
+
+    _fused_qkv_rope_kernel[grid](
+        qkv, cos, sin, position_ids, inv_freq,
+        k_buffer, v_buffer, k_scale, v_scale, select_index,
+        qkv.stride(0),
+        cos.stride(0), sin.stride(0),
+        k_buffer.stride(0), k_buffer.stride(1) if has_kv_buffer else 0,
+        v_buffer.stride(0), v_buffer.stride(1) if has_kv_buffer else 0,
+        k_scale.stride(0), v_scale.stride(0),
+        cos.shape[0],
+        attention_scaling,
+        num_q_heads, num_kv_heads,
+        HEAD_DIM=head_dim,
+        BLOCK_HALF=triton.next_power_of_2(head_dim // 2),
+        HAS_KV_BUFFER=has_kv_buffer,
+        KV_QUANT=kv_quant,
+        HAS_POSITION_IDS=has_position_ids,
+        HAS_INV_FREQ=has_inv_freq,
+        num_warps=1,
+    )
+
+    q_size, kv_size = num_q_heads * head_dim, num_kv_heads * head_dim
+    xq, xk, xv = qkv.split([q_size, kv_size, kv_size], dim=-1)
+    return (
+        xq.view(num_tokens, num_q_heads, head_dim),
+        xk.view(num_tokens, num_kv_heads, head_dim),
+        xv.view(num_tokens, num_kv_heads, head_dim),
+    )
+
+def _rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+def test_fused_qkv_rope():
+    torch.manual_seed(0)
+    B, S, H, KVH, Hd = 2, 128, 32, 8, 128
+    qkv = torch.randn((B * S, (H + 2 * KVH) * Hd), device="cuda", dtype=torch.float16)
+    freqs = torch.randn((1, S, Hd // 2), device="cuda", dtype=torch.float32)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    cos, sin = emb.cos().half(), emb.sin().half()
+
+    q_ref, k_ref, v_ref = qkv.float().split([H * Hd, KVH * Hd, KVH * Hd], dim=-1)
+    q_ref = q_ref.view(B, S, H, Hd)
+    k_ref = k_ref.view(B, S, KVH, Hd)
+    cos_ref, sin_ref = cos.float().unsqueeze(2), sin.float().unsqueeze(2)
+    q_ref = (q_ref * cos_ref + _rotate_half(q_ref) * sin_ref).view(B * S, H, Hd)
+    k_ref = (k_ref * cos_ref + _rotate_half(k_ref) * sin_ref).view(B * S, KVH, Hd)
+    v_ref = v_ref.view(B * S, KVH, Hd)
+
+    k_buffer = torch.zeros((4 * B * S, KVH, Hd), device="cuda", dtype=torch.float16)
+    v_buffer = torch.zeros_like(k_buffer)
+    select_index = torch.randperm(4 * B * S, device="cuda")[: B * S].to(torch.int32)
+    xq, xk, xv = fused_qkv_rope(qkv, cos, sin, H, KVH, Hd, k_buffer, v_buffer, select_index)
+    assert torch.allclose(xq.float(), q_ref, atol=1e-2, rtol=1e-2)
+    assert torch.allclose(xk.float(), k_ref, atol=1e-2, rtol=1e-2)
+    assert torch.allclose(xv.float(), v_ref, atol=1e-2, rtol=1e-2)
+    assert torch.equal(k_buffer[select_index.long()], xk)
+    assert torch.equal(v_buffer[select_index.long()], xv)
+
+    # 传入 position_ids 时从 cos/sin 表中按位置取行, 结果与先 gather 一致
+    max_seq_len = 4 * S
+    freqs_table = torch.randn((max_seq_len, Hd // 2), device="cuda", dtype=torch.float32)
+    emb_table = torch.cat((freqs_table, freqs_table), dim=-1)
+    cos_table, sin_table = emb_table.cos(), emb_table.sin()
+    position_ids = torch.randint(0, max_seq_len, (B, S), device="cuda")
+    qkv = torch.randn((B * S, (H + 2 * KVH) * Hd), device="cuda", dtype=torch.float16)
+    qkv_ref = qkv.clone()
+    xq, xk, _ = fused_qkv_rope(qkv, cos_table, sin_table, H, KVH, Hd, position_ids=position_ids)
+    xq_ref, xk_ref, _ = fused_qkv_rope(qkv_ref, cos_table[position_ids], sin_table[position_ids], H, KVH, Hd)
+    assert torch.equal(xq, xq_ref) and torch.equal(xk, xk_ref)
+
+    # 传入 inv_freq 时超出表长的位置现场计算, 与完整的表一致
+    inv_freq = 1.0 / (10000.0 ** (torch.arange(0, Hd, 2, device="cuda", dtype=torch.float32) / Hd))
+    full_freqs = torch.arange(max_seq_len, device="cuda", dtype=torch.float32)[:, None] * inv_freq[None, :]
+    full_emb = torch.cat((full_freqs, full_freqs), dim=-1)
+    full_cos, full_sin = full_emb.cos(), full_emb.sin()
+    qkv = torch.randn((B * S, (H + 2 * KVH) * Hd), device="cuda", dtype=torch.float16)
+    qkv_ref = qkv.clone()
+    xq, xk, _ = fused_qkv_rope(qkv, full_cos[:S], full_sin[:S], H, KVH, Hd, position_ids=position_ids, inv_freq=inv_freq)
+    xq_ref, xk_ref, _ = fused_qkv_rope(qkv_ref, full_cos, full_sin, H, KVH, Hd, position_ids=position_ids)
+    assert torch.allclose(xq.float(), xq_ref.float(), atol=1e-2, rtol=1e-2)
+    assert torch.allclose(xk.float(), xk_ref.float(), atol=1e-2, rtol=1e-2)
+
+    # int8 kv cache: 反量化后与 fp16 结果的误差不超过半个量化步长
+    k_buffer_int8 = torch.zeros((4 * B * S, KVH, Hd), device="cuda", dtype=torch.int8)
+    v_buffer_int8 = torch.zeros_like(k_buffer_int8)
+    k_scale = torch.zeros((4 * B * S, KVH), device="cuda", dtype=torch.float32)
+    v_scale = torch.zeros_like(k_scale)
+    qkv = torch.randn((B * S, (H + 2 * KVH) * Hd), device="cuda", dtype=torch.float16)
+    xq, xk, xv = fused_qkv_rope(qkv, cos, sin, H, KVH, Hd, k_buffer_int8, v_buffer_int8, select_index, k_scale, v_scale)
+    idx = select_index.long()
+    k_deq = k_buffer_int8[idx].float() * k_scale[idx].unsqueeze(-1)
+    v_deq = v_buffer_int8[idx].float() * v_scale[idx].unsqueeze(-1)
+    assert ((k_deq - xk.float()).abs() <= k_scale[idx].unsqueeze(-1) * 0.5 + 1e-2).all()
+    assert ((v_deq - xv.float()).abs() <= v_scale[idx].unsqueeze(-1) * 0.5 + 1e-2).all()
+
+if __name__ == "__main__":
+    test_fused_qkv_rope()
+    print("fused_qkv_rope test passed")
@@ -3,54 +3,62 @@ import torch
 import triton
 import triton.language as tl
 
-# grid(B*S, 1, 1), 每个block线程组处理一个序列的一个token的KV
+# grid(B*S, 1, 1), 每个block线程组处理一个序列的一个token的K和V
 @triton.jit
 def _fwd_kernel_update_kv(
-    KV_Values, Select_Index, # KV_Values: [select_indexs, num_kv_heads * 2, head_dim], Select_Index: (B*S, )
-    KV_Buffer, # [max_num_tokens, num_kv_heads * 2, head_dim]
-    stride_k_bs, stride_k_h, stride_k_d, # KVH * 2 * Hd, Hd, 1
-    stride_o_bs, stride_o_h, stride_o_d, # KVH * 2 * Hd, Hd, 1
-    head_num, # H
+    K_Values, V_Values, Select_Index, # K_Values/V_Values: [select_indexs, num_kv_heads, head_dim], Select_Index: (B*S, )
+    K_Buffer, V_Buffer, # [max_num_tokens, num_kv_heads, head_dim]
+    stride_k_bs, stride_k_h, stride_k_d, # KVH * Hd, Hd, 1
+    stride_v_bs, stride_v_h, stride_v_d, # KVH * Hd, Hd, 1
+    stride_ko_bs, stride_ko_h, stride_ko_d, # KVH * Hd, Hd, 1
+    stride_vo_bs, stride_vo_h, stride_vo_d, # KVH * Hd, Hd, 1
+    head_num, # KVH
     BLOCK_DMODEL: tl.constexpr, # Hd
-    BLOCK_HEAD: tl.constexpr # H
+    BLOCK_HEAD: tl.constexpr # KVH
 ):
     cur_index = tl.program_id(0)
-    offs_h = tl.arange(0, BLOCK_HEAD) # 0~H
+    offs_h = tl.arange(0, BLOCK_HEAD) # 0~KVH
     offs_d = tl.arange(0, BLOCK_DMODEL) # 0~Hd
+    mask_h = offs_h[:, None] < head_num
 
-    dest_index = tl.load(Select_Index + cur_index)
+    dest_index = tl.load(Select_Index + cur_index).to(tl.int64)
 
-    k_ptrs = KV_Values + cur_index * stride_k_bs + stride_k_h * offs_h[:, None] + stride_k_d * offs_d[None, :]
-    o_ptrs = KV_Buffer + dest_index * stride_o_bs + stride_o_h * offs_h[:, None] + stride_o_d * offs_d[None, :]
+    k_ptrs = K_Values + cur_index * stride_k_bs + stride_k_h * offs_h[:, None] + stride_k_d * offs_d[None, :]
+    v_ptrs = V_Values + cur_index * stride_v_bs + stride_v_h * offs_h[:, None] + stride_v_d * offs_d[None, :]
+    ko_ptrs = K_Buffer + dest_index * stride_ko_bs + stride_ko_h * offs_h[:, None] + stride_ko_d * offs_d[None, :]
+    vo_ptrs = V_Buffer + dest_index * stride_vo_bs + stride_vo_h * offs_h[:, None] + stride_vo_d * offs_d[None, :]
 
-    kv_value = tl.load(k_ptrs, mask=offs_h[:, None] < head_num, other=0.0)
-    tl.store(o_ptrs, kv_value, mask=offs_h[:, None] < head_num)
+    tl.store(ko_ptrs, tl.load(k_ptrs, mask=mask_h, other=0.0), mask=mask_h)
+    tl.store(vo_ptrs, tl.load(v_ptrs, mask=mask_h, other=0.0), mask=mask_h)
     return
 
 
 @torch.no_grad()
-def update_kv_buffer(KV_Values, Select_Index, KV_Buffer):
+def update_kv_buffer(K_Values, V_Values, Select_Index, K_Buffer, V_Buffer):
     """
     参数：
         - Select_Index: prefill 阶段 batch_size * seq_len, decode 阶段 batch_size。
-                        Select_Index[i] 表示 KV_Values 的第 i 行 应该被复制到 KV_Buffer 的第 Select_Index[i] 行。
-        - KV_Values: 实际是 cache_kv, 尺寸为 [select_indexs, num_kv_heads * 2, head_dim]。
-        - KV_Buffer: 尺寸为 [max_num_tokens, num_kv_heads * 2, head_dim]
+                        Select_Index[i] 表示 K_Values/V_Values 的第 i 行 应该被复制到 K_Buffer/V_Buffer 的第 Select_Index[i] 行。
+        - K_Values, V_Values: 尺寸为 [select_indexs, num_kv_heads, head_dim]。
+        - K_Buffer, V_Buffer: K V 分开存储(SoA), 尺寸为 [max_num_tokens, num_kv_heads, head_dim]
     输出:
-        KV_Buffer 张量被填, KV_Buffer[Select_Index[i], :, :] = [K[i, :, :], V[i, :, :]]。
+        K_Buffer[Select_Index[i], :, :] = K[i, :, :], V_Buffer[Select_Index[i], :, :] = V[i, :, :]。
     """
     seq_len = Select_Index.shape[0] # number_tokens
-    head_num = KV_Values.shape[1] # num_kv_head * 2
-    head_dim = KV_Values.shape[2]
-    assert KV_Values.shape[1] == KV_Buffer.shape[1] and KV_Values.shape[2] == KV_Buffer.shape[2]
+    head_num = K_Values.shape[1] # num_kv_head
+    head_dim = K_Values.shape[2]
+    assert K_Values.shape == V_Values.shape
+    assert K_Values.shape[1:] == K_Buffer.shape[1:] == V_Buffer.shape[1:]
     BLOCK_HEAD = triton.next_power_of_2(head_num)
     grid = (seq_len,)
     num_warps = 1
 
     _fwd_kernel_update_kv[grid](
-        KV_Values, Select_Index, KV_Buffer,
-        KV_Values.stride(0), KV_Values.stride(1), KV_Values.stride(2),
-        KV_Buffer.stride(0), KV_Buffer.stride(1), KV_Buffer.stride(2),
+        K_Values, V_Values, Select_Index, K_Buffer, V_Buffer,
+        K_Values.stride(0), K_Values.stride(1), K_Values.stride(2),
+        V_Values.stride(0), V_Values.stride(1), V_Values.stride(2),
+        K_Buffer.stride(0), K_Buffer.stride(1), K_Buffer.stride(2),
+        V_Buffer.stride(0), V_Buffer.stride(1), V_Buffer.stride(2),
         head_num,
         BLOCK_DMODEL=head_dim,
         BLOCK_HEAD=BLOCK_HEAD,
@@ -64,30 +72,34 @@ def test1():
     num_of_times = 1000
 
     B, Seq_Len, H, D = 32, 1024, 12, 128
-    dest = torch.randn((B * Seq_Len, H, D), dtype=torch.float16).cuda()
-    src = torch.randn((B * Seq_Len, H, D), dtype=torch.float16).cuda()
+    k_dest = torch.randn((B * Seq_Len, H, D), dtype=torch.float16).cuda()
+    v_dest = torch.randn((B * Seq_Len, H, D), dtype=torch.float16).cuda()
+    k_src = torch.randn((B * Seq_Len, H, D), dtype=torch.float16).cuda()
+    v_src = torch.randn((B * Seq_Len, H, D), dtype=torch.float16).cuda()
     dest_loc = torch.arange(0, B * Seq_Len, dtype=torch.int32, device="cuda")
 
     for _ in range(10): # Warm up
-        update_kv_buffer(src, dest_loc, dest)
+        update_kv_buffer(k_src, v_src, dest_loc, k_dest, v_dest)
     torch.cuda.synchronize()
 
     t1 = time.time()
     for _ in range(num_of_times):
-        update_kv_buffer(src, dest_loc, dest)
+        update_kv_buffer(k_src, v_src, dest_loc, k_dest, v_dest)
     torch.cuda.synchronize()
     t2 = time.time()
 
     for _ in range(num_of_times):
-        dest[dest_loc] = src
+        k_dest[dest_loc] = k_src
+        v_dest[dest_loc] = v_src
     torch.cuda.synchronize()
     t3 = time.time()
 
     print("Triton Time cost {:.3f} s".format(t2 - t1))
     print("Torch Time cost {:.3f} s".format(t3 - t2))
-    print("max ", torch.max(torch.abs(dest - src)))
-    print("mean ", torch.mean(torch.abs(dest - src)))
-    assert torch.allclose(src, dest, atol=1e-2, rtol=0)
+    print("max ", torch.max(torch.abs(k_dest - k_src)))
+    print("mean ", torch.mean(torch.abs(k_dest - k_src)))
+    assert torch.allclose(k_src, k_dest, atol=1e-2, rtol=0)
+    assert torch.allclose(v_src, v_dest, atol=1e-2, rtol=0)
 
 if __name__ == '__main__':
     test1()
@@ -32,6 +32,16 @@ def keep(conf):
         return False
     return True
 
+@functools.lru_cache
+def _get_max_shared_mem(device_index: int) -> int:
+    return triton.runtime.driver.active.utils.get_device_properties(device_index)["max_shared_mem"]
+
+
+def get_max_shared_mem() -> int:
+    """当前设备每个 block 可用的最大 shared memory 字节数, 用于剔除超出预算的 autotune 配置"""
+    return _get_max_shared_mem(torch.cuda.current_device())
+
+
 def ensure_contiguous(fn):
     @functools.wraps(fn)
     def wrapper(ctx, *args, **kwargs):
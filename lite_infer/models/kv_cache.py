@@ -0,0 +1,83 @@
+import torch
+
+from ..kernels import fused_qkv_rope, flash_decoding
+
+# kv_cache_dtype 配置项到 k_buffer/v_buffer 存储类型的映射
+KV_CACHE_DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int8": torch.int8,
+}
+
+def allocate_kv_cache(
+    num_layers: int,
+    max_num_tokens: int,
+    num_kv_heads: int,
+    head_dim: int,
+    kv_cache_dtype: str = "float16",
+    device="cuda",
+):
+    """
+    按 kv_cache_dtype 为每层分配 k_buffer/v_buffer: (max_num_tokens, KVH, Hd)。
+    int8 时额外为每层分配每个 token 每个 head 的 fp32 反量化系数 k_scale_buffer/v_scale_buffer: (max_num_tokens, KVH),
+    写入时由 fused_qkv_rope 量化, 读取时由 flash_decoding 反量化; 其余类型 scale buffer 为 None。
+    输出:
+        k_buffer, v_buffer, k_scale_buffer, v_scale_buffer, 均为长度 num_layers 的列表(或 None)。
+    """
+    if kv_cache_dtype not in KV_CACHE_DTYPES:
+        raise ValueError(f"Unsupported kv_cache_dtype: {kv_cache_dtype}, expected one of {list(KV_CACHE_DTYPES)}")
+    dtype = KV_CACHE_DTYPES[kv_cache_dtype]
+    shape = (max_num_tokens, num_kv_heads, head_dim)
+
+    k_buffer = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+    v_buffer = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+    if dtype != torch.int8:
+        return k_buffer, v_buffer, None, None
+
+    k_scale_buffer = [torch.zeros(shape[:2], dtype=torch.float32, device=device) for _ in range(num_layers)]
+    v_scale_buffer = [torch.zeros(shape[:2], dtype=torch.float32, device=device) for _ in range(num_layers)]
+    return k_buffer, v_buffer, k_scale_buffer, v_scale_buffer
+
+def get_kv_scales(atten_info, layer_index: int):
+    """int8 kv cache 时返回该层 k/v 的反量化系数 (max_tokens, KVH), 否则返回 (None, None)"""
+    if atten_info.k_buffer[layer_index].dtype != torch.int8:
+        return None, None
+    return atten_info.k_scale_buffer[layer_index], atten_info.v_scale_buffer[layer_index]
+
+def unit_test_int8_kv_cache():
+    """同一份 K V 分别写入 fp16 和 int8 kv cache, 对比 flash_decoding 的输出"""
+    torch.manual_seed(0)
+    B, S, H, KVH, Hd = 2, 300, 32, 8, 128
+    qk_scale = 1.0 / (Hd ** 0.5) * 1.4426950408889634
+
+    qkv = torch.randn((B * S, (H + 2 * KVH) * Hd), device="cuda", dtype=torch.float16)
+    freqs = torch.randn((S, Hd // 2), device="cuda", dtype=torch.float32)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    cos, sin = emb.cos(), emb.sin() # (S, Hd) 的 cos/sin 表
+    position_ids = torch.arange(S, device="cuda").repeat(B, 1) # (B, S)
+    select_index = torch.arange(B * S, device="cuda", dtype=torch.int32)
+
+    q = torch.randn((B, H, Hd), device="cuda", dtype=torch.float16)
+    b_req_tokens_table = select_index.view(B, S)
+    b_seq_len = torch.full((B,), S, device="cuda", dtype=torch.int32)
+
+    outputs = {}
+    for kv_cache_dtype in ("float16", "int8"):
+        k_buffer, v_buffer, k_scale_buffer, v_scale_buffer = allocate_kv_cache(1, B * S, KVH, Hd, kv_cache_dtype)
+        k_scale = k_scale_buffer[0] if k_scale_buffer is not None else None
+        v_scale = v_scale_buffer[0] if v_scale_buffer is not None else None
+        fused_qkv_rope(
+            qkv.clone(), cos, sin, H, KVH, Hd,
+            k_buffer[0], v_buffer[0], select_index, k_scale, v_scale,
+            position_ids=position_ids,
+        )
+        outputs[kv_cache_dtype] = flash_decoding(
+            q, k_buffer[0], v_buffer[0], qk_scale, b_req_tokens_table, b_seq_len, S, k_scale, v_scale
+        )
+
+    max_diff = torch.max(torch.abs(outputs["float16"].float() - outputs["int8"].float()))
+    print(f'The maximum difference between fp16 and int8 kv cache decoding is {max_diff}')
+    assert max_diff < 2e-2
+
+if __name__ == "__main__":
+    unit_test_int8_kv_cache()
@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -5,8 +6,19 @@ import torch.nn.functional as F
 from typing import Optional, Tuple
 from ..kernels import *
 from .model_config import LlamaConfig
+from .kv_cache import allocate_kv_cache, get_kv_scales
 from .RotaryEmbedding import LlamaRotaryEmbedding
 
+try:
+    from flash_attn import flash_attn_varlen_func
+except ImportError: # 未安装 flash-attn 时 prefill 回退到 triton 实现的 flash_attentionv2_no_pad
+    flash_attn_varlen_func = None
+
+def get_cu_seqlens(batch_size: int, seq_len: int, device):
+    # LlamaModel.forward 把 (B, S, D) 展平为 (B*S, D), 第 i 个请求占据 [i*S, (i+1)*S) 行(右侧补齐),
+    # varlen 前缀和按这一布局构造: (B+1, ). causal 下补齐行排在真实 token 之后, 不影响真实 token 的结果
+    return torch.arange(0, (batch_size + 1) * seq_len, seq_len, dtype=torch.int32, device=device)
+
 class FusedAttention(nn.Module):
     def __init__(self,  config: LlamaConfig, cache_k=None, cache_v=None):
         super().__init__()
@@ -18,95 +30,109 @@ class FusedAttention(nn.Module):
         
         self.num_q_heads = config.num_heads
         self.hidden_size = config.num_heads * self.head_dim
+        self.softmax_scale = self.head_dim ** -0.5 # flash-attn 使用以 e 为底的缩放系数
 
-        self.q_proj = nn.Linear(self.hidden_size, self.hidden_size, bias=False, dtype=torch.float16) # (in, out)
-        self.kv_proj_weight = nn.Parameter(torch.rand(self.num_kv_heads * self.head_dim * 2, self.hidden_size, dtype=torch.float16)) # (out, in)
+        # q k v 线性层融合, 一次 GEMM 计算 Q K V
+        self.qkv_proj_weight = nn.Parameter(torch.rand((self.num_q_heads + 2 * self.num_kv_heads) * self.head_dim, self.hidden_size, dtype=torch.float16)) # (out, in)
         self.o_proj = nn.Linear(self.hidden_size, self.hidden_size, bias=False, dtype=torch.float16) # (in, out)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容 q_proj.weight 和 kv_proj_weight 分开存储的权重, 加载时拼接成 qkv_proj_weight
+        q_key, kv_key = prefix + "q_proj.weight", prefix + "kv_proj_weight"
+        if q_key in state_dict and kv_key in state_dict:
+            state_dict[prefix + "qkv_proj_weight"] = torch.cat([state_dict.pop(q_key), state_dict.pop(kv_key)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _o_proj(self, output, residual=None):
+        if residual is None:
+            return self.o_proj(output)
+        # 残差作为 GEMM 的 C 矩阵(beta=1)在 cuBLAS 中直接累加, 省去单独一次 (B*S, D) 的读写
+        return torch.addmm(residual, output, self.o_proj.weight.t())
+
     def context_forward(
         self,
-        x: torch.Tensor, # (B, S, D)
+        x: torch.Tensor, # (num_tokens, D), 所有请求的 token 打包在一起
         atten_info,
         layer_index:int,
-        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None, # (B, S, Hd)
+        position_embeddings: Optional[Tuple] = None, # (cos_cache, sin_cache, position_ids, inv_freq, attention_scaling)
         qk_scale = None,
+        residual: Optional[torch.Tensor] = None, # (num_tokens, D), 不为 None 时在 o_proj GEMM 中加上残差
+        cu_seqlens: Optional[torch.Tensor] = None, # (B+1, ) int32, 按补齐布局构造的前缀和, 由 LlamaModel 每次前向计算一次
+        max_seqlen: Optional[int] = None, # 补齐后的序列长度 S
     ):         
-        batch_size, seq_len, _ = x.shape  # prefill: (B, S, D); decode: (B, 1, D)
-        x = x.view(-1, self.hidden_size) # (B, S, D)->(B*S, D)
-        
-        # 1. 计算 Q K V 并且 reshape 它们尺寸, 方便后续做 self-attention
-        xq = self.q_proj(x) # (B*S, D)@(D, D)->(B*S, D)
-        k_proj_weight, v_proj_weight = torch.split(self.kv_proj_weight, self.num_kv_heads * self.head_dim, dim=0) # (KVH*Hd*2, D)->2个(KVH*Hd, D)
-        xk = F.linear(x, k_proj_weight) # (B*S, D)@(D, KVH*hd)->(B*S, KVH*Hd)
-        xv = F.linear(x, v_proj_weight) # (B*S, D)@(D, KVH*hd)->(B*S, KVH*Hd)
-
-        # 2. 应用旋转位置编码到 Q 和 K, 将 xk, xv 合并, 并写入缓存
-        xq = xq.view(-1, self.num_q_heads, self.head_dim) # (B*S, D)->(B*S, H, Hd)
-        xk = xk.view(-1, self.num_kv_heads, self.head_dim) # (B*S, D)->(B*S, KVH, Hd)
-        xv = xv.view(-1, self.num_kv_heads, self.head_dim) # (B*S, D)->(B*S, KVH, Hd)
-
-        cos, sin = position_embeddings
-        xq, xk = rope_emb_forward(xq, xk, cos, sin, batch_size, seq_len)
-        combined_kv = torch.cat([xk, xv], dim=-2) # (B*S, 2*num_kv_heads, head_dim)  
-        update_kv_buffer(combined_kv, atten_info.cur_select_index, atten_info.kv_buffer[layer_index])
-
-        # 3. sel-attention. flashattention 计算: softmax(qk^t) * v
-        output = flash_attentionv2_no_pad(
-            xq, xk, xv,
-            qk_scale,
-            atten_info.b_start_loc, 
-            atten_info.b_seq_len, 
-            seq_len,
+        # 1. 一次 GEMM 计算打包的 Q K V
+        xqkv = F.linear(x, self.qkv_proj_weight.data) # (B*S, D)@(D, (H+2*KVH)*Hd)->(B*S, (H+2*KVH)*Hd)
+
+        # 2. 原地应用旋转位置编码到 Q 和 K, 得到 (B*S, H, Hd), (B*S, KVH, Hd), (B*S, KVH, Hd) 视图, 同时将 K V 写入缓存
+        cos_cache, sin_cache, position_ids, inv_freq, attention_scaling = position_embeddings
+        xq, xk, xv = fused_qkv_rope(
+            xqkv, cos_cache, sin_cache, self.num_q_heads, self.num_kv_heads, self.head_dim,
+            atten_info.k_buffer[layer_index], atten_info.v_buffer[layer_index], atten_info.cur_select_index,
+            *get_kv_scales(atten_info, layer_index),
+            position_ids=position_ids, inv_freq=inv_freq, attention_scaling=attention_scaling,
         )
 
-        # output = output.view(batch_size*seq_len, self.hidden_size)
-        output = output.view(batch_size, seq_len, self.hidden_size)
-        # 4. attention 输出做线性变换
-        output = self.o_proj(output) # (B, S, D)@(D, D)->(B, S, D)
-        return output
+        # 3. sel-attention. flashattention 计算: softmax(qk^t) * v, 输出为连续的 (B*S, H*Hd), 可直接作为 o_proj 的输入
+        if cu_seqlens is None:
+            max_seqlen = x.shape[0] // atten_info.b_seq_len.shape[0]
+            cu_seqlens = get_cu_seqlens(atten_info.b_seq_len.shape[0], max_seqlen, x.device)
+        if flash_attn_varlen_func is not None:
+            output = flash_attn_varlen_func(
+                xq, xk, xv,
+                cu_seqlens_q=cu_seqlens, cu_seqlens_k=cu_seqlens,
+                max_seqlen_q=max_seqlen, max_seqlen_k=max_seqlen,
+                softmax_scale=self.softmax_scale, causal=True,
+            ).view(-1, self.hidden_size) # (B*S, H, Hd)->(B*S, H*Hd)
+        else:
+            # flash_attentionv2_no_pad 只写每个请求的前 b_seq_len 行, 补齐行置 0, 避免未初始化的数据流入后续层
+            output = torch.zeros((x.shape[0], self.hidden_size), dtype=xq.dtype, device=xq.device)
+            flash_attentionv2_no_pad(
+                xq, xk, xv,
+                qk_scale,
+                cu_seqlens[:-1], # 补齐布局下每个请求的起始行
+                atten_info.b_seq_len, 
+                max_seqlen,
+                output=output,
+            )
+
+        # 4. attention 输出做线性变换, 并加上残差
+        return self._o_proj(output, residual) # (B*S, D)@(D, D)->(B*S, D)
 
     def token_forward(self, 
-        x: torch.Tensor,
+        x: torch.Tensor, # (B, D), decode 阶段每个请求一个 token
         atten_info,
         layer_index:int,
-        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        position_embeddings: Optional[Tuple] = None, # (cos_cache, sin_cache, position_ids, inv_freq, attention_scaling)
         qk_scale = None, 
+        residual: Optional[torch.Tensor] = None,
     ):
-        batch_size, seq_len, _ = x.shape  # prefill: (B, Seq_Len, Dim); decode: (B, 1, Dim)
-        x = x.view(-1, self.hidden_size)
-        
-        # 1. 计算 Q K V 并且 reshape 它们尺寸, 方便后续做 self-attention
-        xq = self.q_proj(x)
-        xkv = F.linear(x, self.kv_proj_weight.data) # (B, L, 2 * num_kv_heads * head_dim)
-        
-        # 2. 应用旋转位置编码到 Q 和 K, 获取 kv 缓冲向量并更新 kv 向量
-        xk, xv = torch.split(xkv, self.num_kv_heads * self.head_dim, dim=-1)
-        xq = xq.view(batch_size, self.num_q_heads, self.head_dim)
-        xk = xk.view(batch_size, self.num_kv_heads, self.head_dim)
-        xv = xv.view(batch_size, self.num_kv_heads, self.head_dim)
+        # 1. 一次 GEMM 计算打包的 Q K V
+        xqkv = F.linear(x, self.qkv_proj_weight.data) # (B, D)@(D, (H+2*KVH)*Hd)->(B, (H+2*KVH)*Hd)
         
-        cos, sin = position_embeddings
-        xq, xk = rope_emb_forward(xq, xk, cos, sin, batch_size, seq_len)
-
-        # 3. 完成形状变换, 并更新 kv_buffer, 即类似 torch.concat[past_kv_values, kv_values]
-        combined_kv = torch.cat([xk, xv], dim=-2) # (BS, 2*num_kv_heads, head_dim)
-        # 更新 kv_buffer, atten_info.kv_buffer[layer_index]
-        update_kv_buffer(combined_kv, atten_info.cur_select_index, atten_info.kv_buffer[layer_index])
+        # 2. 原地应用旋转位置编码到 Q 和 K, 同时更新 k_buffer 和 v_buffer, 即类似 torch.concat[past_kv_values, kv_values]
+        cos_cache, sin_cache, position_ids, inv_freq, attention_scaling = position_embeddings
+        xq, _, _ = fused_qkv_rope(
+            xqkv, cos_cache, sin_cache, self.num_q_heads, self.num_kv_heads, self.head_dim,
+            atten_info.k_buffer[layer_index], atten_info.v_buffer[layer_index], atten_info.cur_select_index,
+            *get_kv_scales(atten_info, layer_index),
+            position_ids=position_ids, inv_freq=inv_freq, attention_scaling=attention_scaling,
+        )
         
-        # 4. flashattention 计算: softmax(qk^t) * v
-        output = flash_decoding(
+        # 3. flashattention 计算: softmax(qk^t) * v, 直接写入连续的 (B, H*Hd) 输出
+        output = torch.empty((x.shape[0], self.hidden_size), dtype=xq.dtype, device=xq.device)
+        flash_decoding(
             xq, 
-            atten_info.kv_buffer[layer_index][:, : self.num_kv_heads, :], 
-            atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :], 
+            atten_info.k_buffer[layer_index],
+            atten_info.v_buffer[layer_index],
             qk_scale,
             atten_info.b_req_tokens_table, 
             atten_info.b_seq_len, 
-            atten_info.max_actual_seq_len
-        ) # ouput shape is [batchs, num_heads, head_dim]; batchs = batch_size(seq_len = 1)
+            atten_info.max_actual_seq_len,
+            *get_kv_scales(atten_info, layer_index),
+            output=output,
+        ) # batchs = batch_size(seq_len = 1)
         
-        output = output.view(batch_size, seq_len, self.hidden_size)
-        output = self.o_proj(output)
-        return output
+        return self._o_proj(output, residual) # (B, D)@(D, D)->(B, D)
 
 class FusedMLP(nn.Module):
 
@@ -120,8 +146,12 @@ class FusedMLP(nn.Module):
         self.up_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False, dtype=torch.float16) # (in, out)
         self.down_proj = nn.Linear(self.intermediate_size, self.hidden_size, bias=False, dtype=torch.float16) # (in, out)
 
-    def forward(self, x):
-        return self.down_proj(swiglu_forward(self.gate_proj(x), self.up_proj(x))) # (B, S, D)
+    def forward(self, x, residual: Optional[torch.Tensor] = None):
+        h = swiglu_forward(self.gate_proj(x), self.up_proj(x))
+        if residual is None:
+            return self.down_proj(h) # (num_tokens, D)
+        # 残差在 down_proj GEMM 中累加: (num_tokens, I)@(I, D) + (num_tokens, D)
+        return torch.addmm(residual, h, self.down_proj.weight.t())
 
 class LlamaDecoderLayer(nn.Module):
 
@@ -139,38 +169,57 @@ class LlamaDecoderLayer(nn.Module):
         self.self_attn = FusedAttention(config)
         self.mlp = FusedMLP(config)
 
-    def forward(self, 
-        hidden_states: torch.Tensor, # (B, S, D)
+    def _forward_prefill(self, 
+        hidden_states: torch.Tensor, # (num_tokens, D)
         atten_info,
         layer_index: int,
-        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None, # (B, S, Hd)
+        position_embeddings: Optional[Tuple] = None, # (cos_cache, sin_cache, position_ids, inv_freq, attention_scaling)
         qk_scale = None,
-        residual: Optional[torch.Tensor] = None
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ):
+        # hidden_states 即残差流, 两个子层的残差加法都在各自输出投影的 GEMM 中完成
         # Normalization before the attention block.
-        _, seq_len, _ = hidden_states.shape # [batch_size, seq_len, hidden_dim]
-        
-        hidden_states, residual = skip_rmsnorm(hidden_states, residual, self.attention_norm_weight.data, self.rmsnorm_eps) # residual: [batch_size, seq_len, hidden_dim]
+        normed_states, _ = skip_rmsnorm(hidden_states, None, self.attention_norm_weight.data, self.rmsnorm_eps)
+        hidden_states = self.self_attn.context_forward(
+            normed_states, atten_info, layer_index, position_embeddings, qk_scale,
+            residual=hidden_states, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen,
+        )
+        return self._forward_mlp(hidden_states, layer_index)
 
-        if seq_len > 1:
-            hidden_states = self.self_attn.context_forward(
-                hidden_states, atten_info, layer_index, position_embeddings, qk_scale
-            )
-        else:
-            hidden_states = self.self_attn.token_forward(
-                hidden_states, atten_info, layer_index, position_embeddings, qk_scale
-            )
+    def _forward_decode(self, 
+        hidden_states: torch.Tensor, # (B, D)
+        atten_info,
+        layer_index: int,
+        position_embeddings: Optional[Tuple] = None, # (cos_cache, sin_cache, position_ids, inv_freq, attention_scaling)
+        qk_scale = None,
+    ):
+        normed_states, _ = skip_rmsnorm(hidden_states, None, self.attention_norm_weight.data, self.rmsnorm_eps)
+        hidden_states = self.self_attn.token_forward(
+            normed_states, atten_info, layer_index, position_embeddings, qk_scale, residual=hidden_states
+        )
+        return self._forward_mlp(hidden_states, layer_index)
 
-        mask_nan = torch.isnan(hidden_states)
-        hidden_states = torch.where(mask_nan, 1e-8, hidden_states)
-        mask_nan = torch.isinf(hidden_states)
-        hidden_states = torch.where(mask_nan, 1e-8, hidden_states)
-        if torch.isnan(hidden_states).any() or torch.isinf(hidden_states).any(): # 检查 NaNs and inf
-            raise ValueError(f"NaNs or inf detected in token_forward output at layer {layer_index}")                
+    def _forward_mlp(self, hidden_states: torch.Tensor, layer_index: int):
+        # NaN/Inf 检查会触发 GPU->CPU 同步, 只在调试时开启
+        if self.config.debug_nan and not torch.isfinite(hidden_states).all(): # 检查 NaNs and inf
+            raise ValueError(f"NaNs or inf detected in attention output at layer {layer_index}")
         
-        hidden_states, residual = skip_rmsnorm(hidden_states, residual, self.ffn_norm_weight.data, self.rmsnorm_eps)
-        hidden_states = self.mlp.forward(hidden_states)
-        return hidden_states, residual
+        normed_states, _ = skip_rmsnorm(hidden_states, None, self.ffn_norm_weight.data, self.rmsnorm_eps)
+        return self.mlp.forward(normed_states, residual=hidden_states)
+
+    def forward(self, 
+        hidden_states: torch.Tensor, # (num_tokens, D)
+        atten_info,
+        layer_index: int,
+        position_embeddings: Optional[Tuple] = None, # (cos_cache, sin_cache, position_ids, inv_freq, attention_scaling)
+        qk_scale = None,
+        *,
+        is_prefill: bool, # 打包布局下无法从 shape 区分阶段(如所有 prompt 长度都为 1 的 prefill), 由调用方显式指定
+    ):
+        if is_prefill:
+            return self._forward_prefill(hidden_states, atten_info, layer_index, position_embeddings, qk_scale)
+        return self._forward_decode(hidden_states, atten_info, layer_index, position_embeddings, qk_scale)
         
 
 class LlamaModel(nn.Module):
@@ -181,12 +230,21 @@ class LlamaModel(nn.Module):
         self.vocab_size = config.vocab_size
         self.num_layers = config.num_layers
         self.head_dim = config.head_dim if config.head_dim is not None else config.hidden_size // config.num_heads
-        self.qk_scale = 1.0 / (self.head_dim ** 0.5)
+        self.qk_scale = 1.0 / (self.head_dim ** 0.5) * 1.4426950408889634 # 以 2 为底, 供 triton kernel 使用 exp2
         self.rmsnorm_eps = config.rms_norm_eps
 
         # self.hidden_states = []
 
         self.rotary_emb = LlamaRotaryEmbedding(config=config)
+        # 初始化时按 [0, max_seq_len) 预计算 cos/sin 表, 前向时由 fused_qkv_rope kernel 按 position_ids 直接取行;
+        # 超出表长的位置(如 LLaVA 图像 token 展开后的长 prompt)由 kernel 按 inv_freq 现场计算, 表无需按 max_position_embeddings 分配
+        cos_cache, sin_cache = self.rotary_emb(
+            torch.empty(0, dtype=torch.float32), torch.arange(config.max_seq_len).unsqueeze(0)
+        ) # (1, max_seq_len, head_dim)
+        self.register_buffer("cos_cache", cos_cache[0], persistent=False) # (max_seq_len, head_dim)
+        self.register_buffer("sin_cache", sin_cache[0], persistent=False)
+        self.register_buffer("inv_freq", self.rotary_emb.inv_freq.detach().float().clone(), persistent=False) # (head_dim//2, )
+        self.rope_attention_scaling = float(getattr(self.rotary_emb, "attention_scaling", 1.0))
         self.embed_tokens = nn.Embedding(self.vocab_size, config.hidden_size, dtype=torch.float16)
         self.norm_weight = nn.Parameter(torch.ones(config.hidden_size,), requires_grad=False) # output RMSNorm->gamma
 
@@ -197,6 +255,121 @@ class LlamaModel(nn.Module):
             [LlamaDecoderLayer(config) for _ in range(config.num_layers)]
         )
 
+        # prefill 和 decode 分开编译, 层内没有依赖 seq_len 的分支, 由 forward 在图外分发
+        # decode 阶段逐 token 的前向额外捕获为 CUDA graph 消除 kernel launch 开销; debug_nan 的检查会打断图, 只在 eager 下运行
+        # triton autotune/lru_cache 等 Python 包装未必能被完整 trace, 不要求 fullgraph, 遇到图断开时回退到 eager 执行该段;
+        # 图断开会把 decode 切成多个小图, 在 GPU 上验证之前 config.enforce_eager 默认为 True, 编译路径需显式开启
+        # prefill 的动态 shape 编译尚未充分验证, 默认 eager, 由 compile_prefill 显式开启
+        self._kv_buffer_static = False
+        self._compiled = not (config.enforce_eager or config.debug_nan)
+        # decode 的 batch 补齐到 2 的幂, 每个桶一份持久的输入缓冲区, 图只随 (batch 桶, seq_len 桶) 重新捕获
+        self._decode_batch_buckets = [1 << i for i in range((max(config.max_batch_size, 1) - 1).bit_length() + 1)]
+        self._decode_static_inputs = {}
+        if self._compiled:
+            self._decode_model = torch.compile(self._decode_forward, mode="reduce-overhead", dynamic=False)
+        else:
+            self._decode_model = self._decode_forward
+        if self._compiled and config.compile_prefill:
+            self._prefill_model = torch.compile(self._prefill_forward, dynamic=True)
+        else:
+            self._prefill_model = self._prefill_forward
+
+    def _prefill_forward(
+        self,
+        h: torch.Tensor, # [num_tokens, hidden_dim]
+        position_ids: torch.Tensor, # [batch_size, seq_len]
+        atten_info,
+    ):
+        """prefill 阶段(seq_len > 1)的前向计算"""
+        position_embeddings = (self.cos_cache, self.sin_cache, position_ids, self.inv_freq, self.rope_attention_scaling)
+        # 各层共享同一份 cu_seqlens, 只在这里构造一次
+        batch_size = atten_info.b_seq_len.shape[0]
+        seq_len = h.shape[0] // batch_size
+        cu_seqlens = get_cu_seqlens(batch_size, seq_len, h.device)
+
+        for i, layer in enumerate(self.layers): # Consecutively apply all the encoder layers
+            h = layer._forward_prefill(h, atten_info, i, position_embeddings, self.qk_scale, cu_seqlens, seq_len)  # h.shape [num_tokens, hidden_dim]
+
+        h, _ = skip_rmsnorm(h, None, self.norm_weight.data, self.rmsnorm_eps)
+        return self.lm_head(h) # (num_tokens, D)->(num_tokens, vocab_size)
+
+    def _decode_forward(
+        self,
+        h: torch.Tensor, # [batch_size, hidden_dim]
+        position_ids: torch.Tensor, # [batch_size, 1]
+        atten_info,
+    ):
+        """decode 阶段(seq_len = 1)的前向计算, 不含依赖 seq_len 的 Python 分支和 GPU->CPU 同步"""
+        position_embeddings = (self.cos_cache, self.sin_cache, position_ids, self.inv_freq, self.rope_attention_scaling)
+
+        for i, layer in enumerate(self.layers):
+            h = layer._forward_decode(h, atten_info, i, position_embeddings, self.qk_scale)
+
+        h, _ = skip_rmsnorm(h, None, self.norm_weight.data, self.rmsnorm_eps)
+        return self.lm_head(h) # (B, D)->(B, vocab_size)
+
+    def _static_decode_inputs(self, h, position_ids, atten_info):
+        """
+        CUDA graph 要求输入地址和 Python 常量固定: 把逐步变化的 decode 输入拷贝进按 batch 分桶预分配的持久缓冲区。
+        pad 行的 b_seq_len 为 0(flash_decoding 不读 kv cache, 输出为 0), cur_select_index 为 -1(fused_qkv_rope 不写 kv cache)。
+        batch 超过最大的桶时返回 None, 由调用方走 eager。
+        """
+        batch_size = h.shape[0]
+        if batch_size > self._decode_batch_buckets[-1]:
+            return None
+        bucket = next(b for b in self._decode_batch_buckets if b >= batch_size)
+
+        if not self._kv_buffer_static:
+            # k_buffer/v_buffer 在图内被原地更新, 标记为静态地址后 CUDA graph 直接读写它们而不是拷贝
+            for layer_index in range(self.num_layers):
+                torch._dynamo.mark_static_address(atten_info.k_buffer[layer_index])
+                torch._dynamo.mark_static_address(atten_info.v_buffer[layer_index])
+                for scale in get_kv_scales(atten_info, layer_index):
+                    if scale is not None:
+                        torch._dynamo.mark_static_address(scale)
+            # 每个 (batch 桶, seq_len 桶) 组合编译一次, 放宽 dynamo 的重编译上限, 避免超限后静默回退到 eager
+            num_seq_buckets = max(atten_info.k_buffer[0].shape[0].bit_length() - 7, 1)
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, len(self._decode_batch_buckets) * num_seq_buckets
+            )
+            self._kv_buffer_static = True
+
+        static = self._decode_static_inputs.get(bucket)
+        if static is None or static[2].b_req_tokens_table.shape[1] != atten_info.b_req_tokens_table.shape[1]:
+            device = h.device
+            static_h = torch.zeros((bucket, h.shape[1]), dtype=h.dtype, device=device)
+            static_position_ids = torch.zeros((bucket, 1), dtype=position_ids.dtype, device=device)
+            static_atten_info = copy.copy(atten_info) # 共享 kv cache, 逐步变化的索引张量替换为持久缓冲区
+            static_atten_info.b_seq_len = torch.zeros((bucket,), dtype=atten_info.b_seq_len.dtype, device=device)
+            static_atten_info.b_req_tokens_table = torch.zeros(
+                (bucket, atten_info.b_req_tokens_table.shape[1]), dtype=atten_info.b_req_tokens_table.dtype, device=device
+            )
+            static_atten_info.cur_select_index = torch.full(
+                (bucket,), -1, dtype=atten_info.cur_select_index.dtype, device=device
+            )
+            for tensor in (static_h, static_position_ids, static_atten_info.b_seq_len,
+                           static_atten_info.b_req_tokens_table, static_atten_info.cur_select_index):
+                torch._dynamo.mark_static_address(tensor)
+            static = (static_h, static_position_ids, static_atten_info)
+            self._decode_static_inputs[bucket] = static
+
+        static_h, static_position_ids, static_atten_info = static
+        static_h[:batch_size].copy_(h)
+        static_position_ids[:batch_size].copy_(position_ids.view(batch_size, 1))
+        static_atten_info.b_seq_len[:batch_size].copy_(atten_info.b_seq_len)
+        static_atten_info.b_seq_len[batch_size:].zero_()
+        static_atten_info.b_req_tokens_table[:batch_size].copy_(atten_info.b_req_tokens_table)
+        static_atten_info.cur_select_index[:batch_size].copy_(atten_info.cur_select_index)
+        static_atten_info.cur_select_index[batch_size:].fill_(-1)
+
+        # max_actual_seq_len 决定 flash_decoding 的分区长度和中间结果大小, 每步变化都会触发重新捕获;
+        # 按 2 的幂向上分桶(下限 256), 短上下文仍用短分区, 图最多重新捕获 log2(最大上下文) 次。
+        # 只能向上取整: stage2 按真实 b_seq_len 遍历分区, 桶小于真实长度会读到未分配的 mid_o
+        seq_len_bucket = max(1 << (atten_info.max_actual_seq_len - 1).bit_length(), 256)
+        assert seq_len_bucket >= atten_info.max_actual_seq_len
+        static_atten_info.max_actual_seq_len = seq_len_bucket
+        return static
+
     def forward(
         self, 
         input_ids: torch.Tensor, # batch_size, seq_len
@@ -204,31 +377,78 @@ class LlamaModel(nn.Module):
         atten_info, 
         inputs_embeds: Optional[torch.Tensor] = None, # [B, S, D]
     ):
-        # self.hidden_states = []
-        batch_size, seq_len = input_ids.shape
-        residual = None
-
         if inputs_embeds is not None: # To support Multi-model Model
-            h = inputs_embeds
+            h = inputs_embeds # LLaVA prefill 时图像 token 已展开, S 大于 input_ids 的长度
         else:
             h = self.get_input_embeddings(input_ids) # (B, S, D)
+        batch_size, seq_len = h.shape[:2]
+        # prefill 的 attention 按 (B, S) 补齐布局构造 cu_seqlens, 调试模式下检查 atten_info 与该布局一致(会引入 GPU 同步)
+        if self.config.debug_nan and seq_len > 1:
+            assert atten_info.b_seq_len.shape[0] == batch_size and int(atten_info.b_seq_len.max()) <= seq_len
+            padded_start_loc = torch.arange(batch_size, device=h.device) * seq_len
+            assert torch.equal(atten_info.b_start_loc.to(padded_start_loc.dtype), padded_start_loc), \
+                "b_start_loc must be the prefix sum of the padded (B, S) layout"
+        # 层内统一使用打包的 (num_tokens, D) 布局, 只在入口展平、出口恢复 (B, S, vocab_size)
+        h = h.view(-1, h.shape[-1])
 
         if seq_len > 1:
-            qk_scale = self.qk_scale * 1.4426950408889634
+            logits = self._prefill_model(h, position_ids, atten_info)
         else:
-            qk_scale = self.qk_scale
-        
-        position_embeddings = self.rotary_emb(h, position_ids) # cos shape is [1, seq_len, head_dim] -> decode: [batch_size, seq_len, head_dim]
-        
-        for i, layer in enumerate(self.layers): # Consecutively apply all the encoder layers
-            # self.hidden_states.append(h)
-            h, residual = layer(h, atten_info, i, position_embeddings, qk_scale, residual)  # h.shape [batch_size, seq_len, hidden_dim]
-
-        h, _ = skip_rmsnorm(h, residual, self.norm_weight.data, self.rmsnorm_eps)
-        # self.hidden_states.append(h)
-        output = self.lm_head(h) # (B, S, D)->(B, S, vocab_size)
-
-        return output
+            static = self._static_decode_inputs(h, position_ids, atten_info) if self._compiled else None
+            if static is not None:
+                logits = self._decode_model(*static)[:batch_size] # 去掉 pad 行
+            else:
+                logits = self._decode_forward(h, position_ids, atten_info)
+        return logits.view(batch_size, seq_len, self.vocab_size)
     
     def get_input_embeddings(self, input_ids: torch.Tensor) -> torch.Tensor:
-        return self.embed_tokens(input_ids) # (B, S)->(B, S, D)
\ No newline at end of file
+        return self.embed_tokens(input_ids) # (B, S)->(B, S, D)
+
+    def allocate_kv_cache(self, max_num_tokens: int, device=None):
+        """按 config.kv_cache_dtype 分配各层 kv cache, 返回 (k_buffer, v_buffer, k_scale_buffer, v_scale_buffer)"""
+        return allocate_kv_cache(
+            self.num_layers, max_num_tokens, self.config.num_kv_heads or self.config.num_heads, self.head_dim,
+            self.config.kv_cache_dtype, device or self.config.device,
+        )
+
+def unit_test_compiled_decode():
+    """decode 阶段 torch.compile + CUDA graph 与 eager 前向的 logits 对比"""
+    from types import SimpleNamespace
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        hidden_size=256, intermediate_size=512, num_heads=4, num_kv_heads=2,
+        num_layers=2, vocab_size=1000, max_seq_len=1024, enforce_eager=False,
+    )
+    model = LlamaModel(config).to("cuda")
+    for param in model.parameters():
+        if param.dim() > 1:
+            param.data.normal_(std=0.02)
+
+    # batch_size = 3 会被补齐到 4, 同时覆盖 pad 行
+    batch_size, num_kv_heads, head_dim = 3, config.num_kv_heads, config.head_dim
+    b_seq_len = torch.tensor([100, 37, 5], dtype=torch.int32, device="cuda") # 含当前 decode token
+    b_req_tokens_table = torch.arange(batch_size * config.max_seq_len, dtype=torch.int32, device="cuda").view(batch_size, -1)
+    position_ids = (b_seq_len - 1).long().unsqueeze(1) # (B, 1)
+    atten_info = SimpleNamespace(
+        k_buffer=[torch.randn(batch_size * config.max_seq_len, num_kv_heads, head_dim, dtype=torch.float16, device="cuda") for _ in range(config.num_layers)],
+        v_buffer=[torch.randn(batch_size * config.max_seq_len, num_kv_heads, head_dim, dtype=torch.float16, device="cuda") for _ in range(config.num_layers)],
+        cur_select_index=b_req_tokens_table.gather(1, position_ids).view(-1),
+        b_req_tokens_table=b_req_tokens_table,
+        b_seq_len=b_seq_len,
+        max_actual_seq_len=int(b_seq_len.max()),
+    )
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, 1), device="cuda")
+
+    # 同一位置重复写入相同的 K V, 多次前向互不影响; 前两次调用用于编译和捕获 CUDA graph
+    for _ in range(3):
+        compiled_logits = model(input_ids, position_ids, atten_info)
+    eager_logits = model._decode_forward(
+        model.get_input_embeddings(input_ids).view(batch_size, -1), position_ids, atten_info
+    ).view(batch_size, 1, -1)
+
+    print("Compiled: ", model._compiled, "Logits Shape:", compiled_logits.shape) # Expected: (3, 1, 1000)
+    print(f'The maximum difference between compiled and eager logits is {torch.max(torch.abs(compiled_logits - eager_logits))}')
+
+if __name__ == "__main__":
+    unit_test_compiled_decode()
@@ -37,6 +37,10 @@ class LlamaConfig:
     max_batch_size: int = 64
     max_seq_len: int = 2048
     device: str = "cuda"
+    debug_nan: bool = False # 每层检查 attention 输出的 NaN/Inf, 会引入 GPU 同步, 仅用于调试
+    enforce_eager: bool = True # 为 True 时 decode 阶段不使用 torch.compile + CUDA graph; 编译路径尚未在 GPU 上验证, 默认关闭
+    compile_prefill: bool = False # 为 True 时 prefill 阶段也整体编译(dynamic shape), 默认走 eager
+    kv_cache_dtype: str = "float16" # kv cache 存储类型: "float16", "bfloat16" 或 "int8"(按 token 和 head 做 absmax 量化)
 
     def __post_init__(self):
         if self.num_heads and self.hidden_size:
@@ -97,6 +101,10 @@ class LlamaConfig:
             'max_batch_size': 64,
             'max_seq_len': 2048,
             'device': "cuda",
+            'debug_nan': False,
+            'enforce_eager': True,
+            'compile_prefill': False,
+            'kv_cache_dtype': "float16",
         }
 
         # 更新缺失的字段
@@ -147,6 +155,7 @@ class Qwen2Config:
     sliding_window: int = 4096
     max_window_layers: int = 21
     device: str = "cuda"
+    kv_cache_dtype: str = "float16" # kv cache 存储类型: "float16", "bfloat16" 或 "int8"(按 token 和 head 做 absmax 量化)
 
     def __init__(self, config_dict: Optional[Dict[str, Any]] = None, **kwargs):
         self.sliding_window = self.sliding_window if self.use_sliding_window else None
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from typing import Optional, Tuple
 
 from .model_config import Qwen2Config
+from .kv_cache import allocate_kv_cache, get_kv_scales
 from .RotaryEmbedding import Qwen2RotaryEmbedding
 from ..kernels import *
 
@@ -25,12 +26,8 @@ class Attention(nn.Module):
         layer_index:int,
         qk_scale = None,
     ) -> torch.Tensor:
-        # 1. 获取 prefill 阶段的 cur_select_index, 并更新 kv cache 张量
-        combined_kv = torch.cat([xk, xv], dim=-2) # (B, L, 2*num_kv_heads, head_dim)
-        # 更新 kv_buffer, atten_info.kv_buffer[layer_index]
-        update_kv_buffer(combined_kv, atten_info.cur_select_index, atten_info.kv_buffer[layer_index])
-
-        # 2. sel-attention. flashattention 计算: softmax(qk^t) * v
+        # kv cache 已在 fused_qkv_rope 中写入 atten_info.k_buffer[layer_index] 和 atten_info.v_buffer[layer_index]
+        # sel-attention. flashattention 计算: softmax(qk^t) * v
         output = flash_attentionv2_no_pad(
             xq, xk, xv,
             qk_scale,
@@ -49,19 +46,17 @@ class Attention(nn.Module):
         qk_scale = None, # 计算 attention 分数缩放的系数
     ) -> torch.Tensor:
         # xq = xq.to(torch.float16)
-        # 1. 先获取 kv 缓冲向量再更新 kv_buffer, atten_info.kv_buffer[layer_index]
-        combined_kv = torch.cat([xk, xv], dim=-2) # (B*L, 2*num_kv_heads, head_dim)
-        update_kv_buffer(combined_kv, atten_info.cur_select_index, atten_info.kv_buffer[layer_index])
-
-        # 2. flashattention 计算: softmax(qk^t) * v
+        # kv cache 已在 fused_qkv_rope 中写入 atten_info.k_buffer[layer_index] 和 atten_info.v_buffer[layer_index]
+        # flashattention 计算: softmax(qk^t) * v
         output = flash_decoding(
             xq,
-            atten_info.kv_buffer[layer_index][:, : self.num_kv_heads, :], 
-            atten_info.kv_buffer[layer_index][:, self.num_kv_heads:, :], 
+            atten_info.k_buffer[layer_index],
+            atten_info.v_buffer[layer_index],
             qk_scale,
             atten_info.b_req_tokens_table, 
             atten_info.b_seq_len, 
-            atten_info.max_actual_seq_len
+            atten_info.max_actual_seq_len,
+            *get_kv_scales(atten_info, layer_index),
         ) # shape is [batch_size*seq_len, num_heads, head_dim]
 
         return output
@@ -80,33 +75,41 @@ class Qwen2Attention(nn.Module):
         self.num_heads = num_heads
         self.head_dim = hidden_size // num_heads
 
-        self.q_proj_weight = nn.Parameter(torch.rand(hidden_size, hidden_size, dtype=torch.float16))
-        self.q_proj_bias = nn.Parameter(torch.rand(hidden_size, dtype=torch.float16))
-
-        self.kv_proj_weight = nn.Parameter(torch.rand(self.num_kv_heads * self.head_dim * 2, self.hidden_size, dtype=torch.float16))
-        self.kv_proj_bias = nn.Parameter(torch.rand(self.num_kv_heads * self.head_dim * 2, dtype=torch.float16))
+        # q k v 线性层融合, 一次 GEMM 计算 Q K V
+        qkv_size = (self.num_heads + 2 * self.num_kv_heads) * self.head_dim
+        self.qkv_proj_weight = nn.Parameter(torch.rand(qkv_size, hidden_size, dtype=torch.float16))
+        self.qkv_proj_bias = nn.Parameter(torch.rand(qkv_size, dtype=torch.float16))
         self.o_proj_weight = nn.Parameter(torch.rand(hidden_size, hidden_size, dtype=torch.float16))
 
         self.attn = Attention(num_heads, num_kv_heads, self.head_dim)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容 q_proj 和 kv_proj 分开存储的权重, 加载时拼接成 qkv_proj
+        for name in ("weight", "bias"):
+            q_key, kv_key = f"{prefix}q_proj_{name}", f"{prefix}kv_proj_{name}"
+            if q_key in state_dict and kv_key in state_dict:
+                state_dict[f"{prefix}qkv_proj_{name}"] = torch.cat([state_dict.pop(q_key), state_dict.pop(kv_key)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _get_qkv(
         self, 
         x: torch.Tensor,
+        atten_info,
+        layer_index:int,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> torch.Tensor:
-        batch_size, seq_len, _ = x.shape  # prefill: (B, Seq_Len, Dim); decode: (B, 1, Dim)
         x = x.view(-1, self.hidden_size)
 
-        xq = F.linear(x, self.q_proj_weight.data, bias=self.q_proj_bias.data)
-        xkv = F.linear(x, self.kv_proj_weight.data, bias=self.kv_proj_bias.data)
-        xk, xv = torch.split(xkv, self.num_kv_heads * self.head_dim, dim=-1)
-
-        xq = xq.view(batch_size*seq_len, self.num_heads, self.head_dim)
-        xk = xk.view(batch_size*seq_len, self.num_kv_heads, self.head_dim)
-        xv = xv.view(batch_size*seq_len, self.num_kv_heads, self.head_dim)
+        # 一次 GEMM 得到打包的 Q K V: (B*S, D)@(D, (H+2*KVH)*Hd)->(B*S, (H+2*KVH)*Hd)
+        xqkv = F.linear(x, self.qkv_proj_weight.data, bias=self.qkv_proj_bias.data)
 
+        # 原地对 Q K 应用旋转位置编码, xq, xk, xv 均为 xqkv 上的视图, 无需拷贝, 同时将 K V 分别写入 k_buffer, v_buffer
         cos, sin = position_embeddings
-        xq, xk = rope_emb_forward(xq, xk, cos, sin, batch_size, seq_len)
+        xq, xk, xv = fused_qkv_rope(
+            xqkv, cos, sin, self.num_heads, self.num_kv_heads, self.head_dim,
+            atten_info.k_buffer[layer_index], atten_info.v_buffer[layer_index], atten_info.cur_select_index,
+            *get_kv_scales(atten_info, layer_index),
+        )
 
         return xq, xk, xv
     
@@ -121,7 +124,7 @@ class Qwen2Attention(nn.Module):
         batch_size, seq_len, _ = x.shape
 
         # 计算 attention 的输入 q、k、v
-        xq, xk, xv = self._get_qkv(x, position_embeddings)
+        xq, xk, xv = self._get_qkv(x, atten_info, layer_index, position_embeddings)
 
         # 根据输入张量 seq_len 长度选择 context_forward 还是 token_forward
         if seq_len > 1:
@@ -208,6 +211,7 @@ class Qwen2Model(nn.Module):
         super().__init__()
 
         assert config.vocab_size != -1, "Vocab size must be set"
+        self.config = config
         self.rmsnorm_eps = config.rms_norm_eps
 
         hidden_size = config.hidden_size
@@ -215,7 +219,7 @@ class Qwen2Model(nn.Module):
         num_layers = config.num_layers
         head_dim = config.head_dim if config.head_dim is not None else config.hidden_size // config.num_heads
 
-        self.qk_scale = 1.0 / (head_dim ** 0.5)
+        self.qk_scale = 1.0 / (head_dim ** 0.5) * 1.4426950408889634 # 以 2 为底, 供 triton kernel 使用 exp2
 
         self.rotary_emb = Qwen2RotaryEmbedding(config=config)
         
@@ -247,10 +251,7 @@ class Qwen2Model(nn.Module):
         else:
             h = self.get_input_embeddings(input_ids)
 
-        if seq_len > 1:
-            qk_scale = self.qk_scale * 1.4426950408889634
-        else:
-            qk_scale = self.qk_scale
+        qk_scale = self.qk_scale
 
         position_embeddings = self.rotary_emb(h, position_ids)
        
@@ -265,4 +266,13 @@ class Qwen2Model(nn.Module):
     
     def get_input_embeddings(self, input_ids: torch.Tensor) -> torch.Tensor:
         return self.embed_tokens(input_ids)
+
+    def allocate_kv_cache(self, max_num_tokens: int, device=None):
+        """按 config.kv_cache_dtype 分配各层 kv cache, 返回 (k_buffer, v_buffer, k_scale_buffer, v_scale_buffer)"""
+        config = self.config
+        head_dim = config.head_dim if config.head_dim is not None else config.hidden_size // config.num_heads
+        return allocate_kv_cache(
+            config.num_layers, max_num_tokens, config.num_kv_heads, head_dim,
+            config.kv_cache_dtype, device or config.device,
+        )
     
\ No newline at end of file